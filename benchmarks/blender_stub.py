@@ -0,0 +1,72 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import sys
+import types
+
+
+# Root of the repository, the addon package lives in it
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StandInTypes(types.ModuleType):
+    """
+    Stand-in for bpy.types, every attribute is an empty class so the
+    addon's classes can still derive from Blender's.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        cls = type(name, (object,), {})
+        setattr(self, name, cls)
+        return cls
+
+
+class StandInProps(types.ModuleType):
+    """
+    Stand-in for bpy.props, the property definitions are evaluated when
+    the addon's classes are created but never used by the benchmarks.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+# Make the addon's modules importable outside of Blender. The benchmarks
+# only time code working on plain python and numpy data, so bpy is
+# replaced by an empty stand-in when it can't be imported. The package
+# __init__ files registering the whole addon are skipped.
+def setup():
+    try:
+        import bpy
+    except ImportError:
+        bpy = types.ModuleType('bpy')
+        bpy.types = StandInTypes('bpy.types')
+        bpy.props = StandInProps('bpy.props')
+        sys.modules['bpy'] = bpy
+
+    if REPO_FOLDER not in sys.path:
+        sys.path.insert(0, REPO_FOLDER)
+    for name in ('btop', 'btop.nodes'):
+        if name not in sys.modules:
+            package = types.ModuleType(name)
+            package.__path__ = [os.path.join(REPO_FOLDER, *name.split('.'))]
+            sys.modules[name] = package
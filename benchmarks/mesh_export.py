@@ -0,0 +1,116 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+#
+# Times turning the buffers of a uv mapped mesh into the arrays of a
+# trianglemesh shape and formatting them, the per element python code of
+# the old exporter against triangulateUV and fmt_array.
+#
+# Reading the mesh out of Blender isn't part of it, the old exporter went
+# through bmesh and python objects there as well while the new one uses
+# foreach_get, so the real difference is larger than measured here.
+#
+# Usage: python benchmarks/mesh_export.py [triangle count]
+#
+
+import sys
+import time
+
+import numpy as np
+
+import blender_stub
+blender_stub.setup()
+
+from btop.misc import fmt_array
+from btop.misc import set_precision
+from btop.misc import triangulateUV
+from btop.misc.triangulate import MeshBuffers
+
+
+# Buffers of a grid of quads with about triangle_count triangles, split
+# into loop triangles the way Blender does
+def make_grid(triangle_count):
+    size = max(1, int(np.sqrt(triangle_count / 2)))
+    xs, ys = np.meshgrid(np.arange(size + 1, dtype=np.float32), np.arange(size + 1, dtype=np.float32))
+    points = np.stack((xs.ravel(), ys.ravel(), np.sin(xs.ravel() * 0.1) * np.cos(ys.ravel() * 0.1)), axis=1)
+
+    # Vertex indices of the quads, counter clockwise
+    quad = np.arange(size * size)
+    row = quad // size
+    corner = quad % size + row * (size + 1)
+    quad_verts = np.stack((corner, corner + 1, corner + size + 2, corner + size + 1), axis=1)
+
+    # Every quad has its own four loops, like a mesh with uv seams everywhere
+    quad_loops = np.arange(size * size * 4).reshape(-1, 4)
+    split = [0, 1, 2, 0, 2, 3]
+    tri_verts = quad_verts[:, split].ravel().astype(np.int32)
+    tri_loops = quad_loops[:, split].ravel().astype(np.int32)
+
+    normals = np.tile(np.array([[0, 0, 1]], dtype=np.float32), (len(quad_loops) * 4, 1))
+    uvs = points[quad_verts.ravel(), :2] / size
+    return MeshBuffers(points, tri_verts, tri_loops, normals, uvs.astype(np.float32))
+
+
+# What the old exporter did with the same data: gather the attributes of
+# every triangle corner into python lists, then format them value by value
+def export_per_element(buffers):
+    points = [tuple(p) for p in buffers.points.tolist()]
+    normals = [tuple(n) for n in buffers.normals.tolist()]
+    uvs = [tuple(uv) for uv in buffers.uvs.tolist()]
+
+    verts, corner_normals, corner_uvs, indices = [], [], [], []
+    for corner, (vert, loop) in enumerate(zip(buffers.tri_verts.tolist(), buffers.tri_loops.tolist())):
+        verts.append(points[vert])
+        corner_normals.append(normals[loop])
+        corner_uvs.append(uvs[loop])
+        indices.append(corner)
+
+    vert_str = ''
+    for vert in verts:
+        vert_str += '{} {} {} '.format(*vert)
+    normal_str = ''
+    for n in corner_normals:
+        normal_str += '{} {} {} '.format(*n)
+    uv_str = ''
+    for uv in corner_uvs:
+        uv_str += '{} {} '.format(*uv)
+    face_str = ''
+    for face in indices:
+        face_str += '{} '.format(face)
+    return len(vert_str) + len(normal_str) + len(uv_str) + len(face_str)
+
+
+def export_bulk(buffers):
+    points, normals, uvs, indices = triangulateUV(buffers)
+    return len(fmt_array(points.ravel(), 'position')) + len(fmt_array(normals.ravel(), 'normal')) + \
+        len(fmt_array(uvs.ravel(), 'uv')) + len(fmt_array(indices))
+
+
+def main():
+    triangle_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    set_precision()
+    buffers = make_grid(triangle_count)
+    print('{} triangles, {} vertices'.format(len(buffers.tri_verts) // 3, len(buffers.points)))
+
+    for label, func in (('per element', export_per_element), ('bulk', export_bulk)):
+        start = time.perf_counter()
+        size = func(buffers)
+        print('{:12s} {:8.2f}s  {:6.1f} MB of text'.format(label, time.perf_counter() - start, size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+#
+# Times the removed ear clipping against the loop triangles path on an
+# ngon heavy mesh, like the caps and flanges of CAD imports. The loop
+# triangles Blender computes for the ngons are made up as fans here,
+# computing them is Blender's job and not part of the timing.
+#
+# The old triangulate_a_ngon used mathutils, it's ported below with a
+# minimal pure python vector in its place. Its vector math runs in python
+# instead of C, so the old timing is an upper bound. The port keeps the
+# original's logic, bugs included, since the point is its cost.
+#
+# Usage: python benchmarks/ngon_triangulation.py [ngon count]
+#
+
+import math
+import sys
+import time
+
+import numpy as np
+
+from collections import deque
+
+import blender_stub
+blender_stub.setup()
+
+from btop.misc import fmt_array
+from btop.misc import set_precision
+from btop.misc import triangulate
+from btop.misc import triangulateUV
+from btop.misc.triangulate import MeshBuffers
+
+
+class Vector(object):
+    """
+    The part of mathutils.Vector the old ear clipping used.
+    """
+
+    __slots__ = ('x', 'y', 'z')
+
+    def __init__(self, values):
+        self.x, self.y = values[0], values[1]
+        self.z = values[2] if len(values) > 2 else 0.0
+
+    def __add__(self, other):
+        return Vector((self.x + other.x, self.y + other.y, self.z + other.z))
+
+    def __sub__(self, other):
+        return Vector((self.x - other.x, self.y - other.y, self.z - other.z))
+
+    def __mul__(self, scale):
+        return Vector((self.x * scale, self.y * scale, self.z * scale))
+
+    @property
+    def length(self):
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    @property
+    def xy(self):
+        return Vector((self.x, self.y))
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self, other):
+        return Vector((self.y * other.z - self.z * other.y,
+                       self.z * other.x - self.x * other.z,
+                       self.x * other.y - self.y * other.x))
+
+    def normalize(self):
+        length = self.length
+        if length > 0:
+            self.x, self.y, self.z = self.x / length, self.y / length, self.z / length
+
+    def to_tuple(self):
+        return self.x, self.y, self.z
+
+
+class Matrix(object):
+    """
+    The part of mathutils.Matrix the old ear clipping used.
+    """
+
+    __slots__ = ('rows',)
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __matmul__(self, vector):
+        return Vector(tuple(row.dot(vector) for row in self.rows))
+
+
+#
+# triangulate_a_ngon and its helpers as they were before the loop
+# triangles path, with mathutils swapped for the classes above
+#
+def get_normal(verts):
+    n = Vector((0, 0, 0))
+    for i in range(len(verts)):
+        vert_curr = verts[i - 1]
+        vert_next = verts[i]
+        vec_a = vert_curr - vert_next
+        vec_b = vert_curr + vert_next
+        n += Vector((vec_a.x * vec_b.x, vec_a.y * vec_b.y, vec_a.z * vec_b.z))
+
+    n.normalize()
+    return n
+
+
+def get_local_frame(normal):
+    const_front = Vector((0, 1, 0))
+    right_vec = const_front.cross(normal)
+
+    if right_vec.length < 0.0000001:
+        right_vec = Vector((1, 0, 0))
+        front_vec = Vector((0, 0, -1))
+    else:
+        front_vec = normal.cross(right_vec)
+
+    return Matrix((right_vec, front_vec, normal))
+
+
+def is_convex(vert_prev, vert_curr, vert_next):
+    vec_a = Vector((*((vert_curr - vert_prev).to_tuple()[:2]), 0))
+    vec_b = Vector((*((vert_next - vert_curr).to_tuple()[:2]), 0))
+
+    if vec_a.cross(vec_b).z > -1:
+        return True
+    else:
+        return False
+
+
+def is_in_triangle(v1, v2, v3, vert):
+    def singed_area(v1, v2, v3):
+        return v1.x * (v2.y - v3.y) + v2.y * (v3.y - v1.y) + v3.y * (v1.y - v2.y) > 0
+
+    return singed_area(v1, v2, vert) and singed_area(v2, v3, vert) and singed_area(v3, v1, vert)
+
+
+def triangulate_a_ngon(verts, vert_indices):
+    normal = get_normal(verts)
+    frame = get_local_frame(normal)
+
+    projected_verts = []
+    convex_flags = []
+    for vert in verts:
+        projected = frame @ vert
+        projected_verts.append(projected.xy)
+
+    for i in range(len(projected_verts)):
+        vert_curr = projected_verts[i]
+        vert_prev = projected_verts[i - 1]
+        vert_next = projected_verts[(i + 1) % len(projected_verts)]
+        convex_flags.append(is_convex(vert_prev, vert_curr, vert_next))
+
+    verts_queue = deque()
+    for i in range(len(verts)):
+        verts_queue.append((verts[i], vert_indices[i], i))
+
+    new_triangles = []
+
+    while len(verts_queue) > 3:
+        vert, vert_index, i = verts_queue.popleft()
+
+        if convex_flags[i]:
+            is_ear = True
+            for i in range(1, len(verts_queue) - 1):
+                if is_in_triangle(verts_queue[-1][0], vert, verts_queue[0][0], verts_queue[i][0]):
+                    is_ear = False
+                    break
+
+            if is_ear:
+                new_triangles.append((verts_queue[-1][2], i, verts_queue[0][2]))
+
+                idx_a = verts_queue[-1][2]
+                convex_flags[idx_a] = is_convex(projected_verts[verts_queue[-2][2]],
+                                                projected_verts[verts_queue[-1][2]],
+                                                projected_verts[verts_queue[0][2]])
+                idx_b = verts_queue[0][2]
+                convex_flags[idx_b] = is_convex(projected_verts[verts_queue[-1][2]],
+                                                projected_verts[verts_queue[0][2]],
+                                                projected_verts[verts_queue[1][2]])
+
+            else:
+                verts_queue.append((vert, vert_index, i))
+
+        else:
+            verts_queue.append((vert, vert_index, i))
+
+    new_triangles.append((verts_queue[0][2], verts_queue[1][2], verts_queue[2][2]))
+
+    return new_triangles
+
+
+# The old triangulate on the same ngons, the vertices come in as vectors
+# and the faces as vertex index lists like Blender handed them over
+def triangulate_old(points, faces):
+    verts = [Vector(point) for point in points.tolist()]
+
+    new_triangles = []
+    for face in faces:
+        face_verts = [verts[idx] for idx in face]
+        new_triangles += triangulate_a_ngon(face_verts, face)
+
+    return verts, new_triangles
+
+
+# Buffers and faces of ngon_count disconnected regular polygons with 5 to 64 sides
+def make_ngons(ngon_count, seed=0):
+    rng = np.random.default_rng(seed)
+    sides = rng.integers(5, 65, ngon_count)
+    starts = np.concatenate(([0], np.cumsum(sides)[:-1]))
+
+    # Corner c of ngon i sits on a circle around the ngon's center
+    ngon = np.repeat(np.arange(ngon_count), sides)
+    corner = np.arange(sides.sum()) - starts[ngon]
+    angle = 2 * np.pi * corner / sides[ngon]
+    centers = rng.random((ngon_count, 3)) * 100
+    points = centers[ngon] + np.stack((np.cos(angle), np.sin(angle), np.zeros_like(angle)), axis=1)
+
+    # Fan triangles (0, c, c + 1) of every ngon
+    tri_ngon = np.repeat(np.arange(ngon_count), sides - 2)
+    tri_corner = np.arange(len(tri_ngon)) - np.repeat(np.cumsum(sides - 2) - (sides - 2), sides - 2) + 1
+    first = starts[tri_ngon]
+    tri_verts = np.stack((first, first + tri_corner, first + tri_corner + 1), axis=1).ravel().astype(np.int32)
+
+    # One loop per corner, flat normals and planar uvs
+    normals = np.tile(np.array([[0, 0, 1]], dtype=np.float32), (len(points), 1))
+    uvs = (points[:, :2] / 100).astype(np.float32)
+    faces = np.split(np.arange(len(points)), starts[1:])
+    return MeshBuffers(points.astype(np.float32), tri_verts, tri_verts.copy(), normals, uvs), \
+        [face.tolist() for face in faces]
+
+
+def format_arrays(arrays):
+    kinds = ('position', 'normal', 'uv', 'value') if len(arrays) == 4 else ('position', 'value')
+    return sum(len(fmt_array(array.ravel(), kind)) for array, kind in zip(arrays, kinds))
+
+
+def main():
+    ngon_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    set_precision()
+    buffers, faces = make_ngons(ngon_count)
+    print('{} ngons, {} triangles, {} vertices'.format(ngon_count, len(buffers.tri_verts) // 3, len(buffers.points)))
+
+    # The old path's triangles go through the same formatting as the new ones
+    start = time.perf_counter()
+    verts, triangles = triangulate_old(buffers.points, faces)
+    triangulated = time.perf_counter()
+    size = format_arrays((np.array([v.to_tuple() for v in verts]), np.array(triangles, dtype=np.int32)))
+    print('{:14s} triangulate {:6.2f}s  format {:6.2f}s  {:6.1f} MB of text'.format(
+        'ear clipping', triangulated - start, time.perf_counter() - triangulated, size / 1e6))
+
+    for label, func in (('loop triangles', triangulate), ('with uvs', triangulateUV)):
+        start = time.perf_counter()
+        arrays = func(buffers)
+        triangulated = time.perf_counter()
+        size = format_arrays(arrays)
+        print('{:14s} triangulate {:6.2f}s  format {:6.2f}s  {:6.1f} MB of text'.format(
+            label, triangulated - start, time.perf_counter() - triangulated, size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
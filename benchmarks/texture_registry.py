@@ -0,0 +1,122 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+#
+# Times exporting a layered material through the TextureRegistry against
+# the old recursive export, which declared a texture again every time it
+# was reached. Every layer mixes the two layers below it with a noise
+# mask, so the old export grows like the fibonacci numbers with the
+# number of layers.
+#
+# Usage: python benchmarks/texture_registry.py [layer count]
+#
+
+import io
+import sys
+import time
+
+import blender_stub
+blender_stub.setup()
+
+from btop.misc import set_precision
+from btop.nodes import shading
+
+
+class Socket(object):
+    def __init__(self, socket_type, default_value, from_node=None):
+        self.type = socket_type
+        self.default_value = default_value
+        self.links = [Link(from_node)] if from_node is not None else []
+        self.is_linked = from_node is not None
+
+
+class Link(object):
+    def __init__(self, from_node):
+        self.from_node = from_node
+
+
+# Node of one of the addon's node classes with its properties and inputs
+# set directly, the way Blender would hold them
+def make_node(cls, name, inputs, **props):
+    node = object.__new__(cls)
+    node.__dict__.update(props, name=name, inputs=inputs)
+    node.__dict__['as_pointer'] = lambda: id(node)
+    return node
+
+
+MAPPING = dict(mapping='uv', uscale=1, vscale=1, udelta=0, vdelta=0)
+
+
+# Material whose diffuse color is layer_count mix textures stacked on
+# each other, with one fbm mask per layer
+def make_material(layer_count):
+    base = make_node(shading.PBRTTextureNodeFbm, 'base', {}, octaves=8, roughness=0.5, **MAPPING)
+    layers = [base, base]
+    for i in range(layer_count):
+        mask = make_node(shading.PBRTTextureNodeWrinkled, 'mask{}'.format(i), {}, octaves=4, roughness=0.5, **MAPPING)
+        layer = make_node(shading.PBRTTextureNodeMix, 'layer{}'.format(i), {
+            'tex1': Socket('RGBA', (0, 0, 0, 1), layers[-1]),
+            'tex2': Socket('RGBA', (1, 1, 1, 1), layers[-2]),
+            'amount': Socket('VALUE', 0.5, mask),
+        }, **MAPPING)
+        layers.append(layer)
+
+    return make_node(shading.PBRTShaderNodeMatte, 'matte', {
+        'Kd': Socket('RGBA', (1, 1, 1, 1), layers[-1]),
+        'sigma': Socket('VALUE', 0),
+    })
+
+
+class RedeclaringRegistry(shading.TextureRegistry):
+    """
+    Forgets every declared texture right away, so each node is declared
+    again whenever a socket reaches it like the old recursive export did.
+    """
+
+    def export(self, node, texture_type, file_writer, indent=0):
+        name = super().export(node, texture_type, file_writer, indent)
+        del self.names[(node.as_pointer(), texture_type)]
+        self.used_names.discard(name)
+        return name
+
+
+def time_export(material, registry_class):
+    buffer = io.StringIO()
+    start = time.perf_counter()
+    material.export_named('layered', 0, buffer, registry_class('layered'))
+    elapsed = time.perf_counter() - start
+    return elapsed, buffer.getvalue().count('Texture "')
+
+
+def main():
+    layer_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    set_precision()
+
+    material = make_material(layer_count)
+    elapsed, declarations = time_export(material, shading.TextureRegistry)
+    print('registry, {} layers ({} nodes): {:.4f}s, {} texture declarations'.format(
+        layer_count, 2 * layer_count + 1, elapsed, declarations))
+
+    # The old export is only feasible for a few layers
+    for count in (10, 15, 20, 25):
+        elapsed, declarations = time_export(make_material(count), RedeclaringRegistry)
+        print('recursive, {} layers ({} nodes): {:.4f}s, {} texture declarations'.format(
+            count, 2 * count + 1, elapsed, declarations))
+
+
+if __name__ == '__main__':
+    main()
@@ -42,20 +42,24 @@ def register():
     from . import render
     from . import ui
     from . import nodes
+    from . import sceneio
 
     render.register()
     ui.register()
     nodes.register()
+    sceneio.register()
 
 
 def unregister():
     from . import render
     from . import ui
     from . import nodes
+    from . import sceneio
 
     render.unregister()
     ui.unregister()
     nodes.unregister()
+    sceneio.unregister()
 
 
 if __name__ == '__main__':
@@ -17,5 +17,10 @@
 
 from .triangulate import triangulate
 from .triangulate import triangulateUV
+from .triangulate import read_mesh_buffers
+from .formatter import fmt
+from .formatter import fmt_values
+from .formatter import fmt_array
+from .formatter import set_precision
 from .helper import registry
 from .helper import PBRTNodeTypes
@@ -0,0 +1,65 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+#
+# Float formatting shared by all the exporters.
+#
+# Values are written with a fixed number of significant digits depending
+# on what they describe instead of python's shortest round trip repr,
+# which often ends up with 17 digits. float32 needs 9 significant digits
+# to round trip, so that's the full precision for positions, normals, uvs
+# and colors are fine with a lot less.
+#
+# Kinds of values:
+# - position: vertex positions, locations and transformations
+# - normal: vertex normals and directions
+# - uv: texture coordinates
+# - value: colors and all the other parameters
+#
+
+# printf style templates of each kind, e.g. '%.6g'
+templates = {}
+
+
+def set_precision(position_digits=9, normal_digits=6, value_digits=6):
+    templates['position'] = '%.{}g'.format(position_digits)
+    templates['normal'] = '%.{}g'.format(normal_digits)
+    templates['uv'] = '%.{}g'.format(normal_digits)
+    templates['value'] = '%.{}g'.format(value_digits)
+
+
+set_precision()
+
+
+# Format a single float
+def fmt(value, kind='value'):
+    return templates[kind] % value
+
+
+# Format a sequence of floats separated by spaces, e.g. a color or a vector
+def fmt_values(values, kind='value'):
+    return ' '.join([templates[kind]] * len(values)) % tuple(values)
+
+
+# Format a flat numpy array separated by spaces. Formatting the whole chunk
+# with one template is a lot faster than formatting value by value, integer
+# arrays are written as they are.
+def fmt_array(array, kind='value'):
+    values = array.tolist()
+    if array.dtype.kind != 'f':
+        return ' '.join(map(str, values))
+    return ' '.join([templates[kind]] * len(values)) % tuple(values)
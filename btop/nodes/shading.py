@@ -19,6 +19,8 @@ import bpy
 
 from ..misc import PBRTNodeTypes
 from ..misc import registry
+from ..misc import fmt
+from ..misc import fmt_values
 
 
 socket_type_mapping = {
@@ -33,6 +35,146 @@ attribute_type_mapping = {
 }
 
 
+# Scene syntax version the textures of a material are exported for
+def get_version(textures):
+    return textures.version if textures is not None else 3
+
+
+# pbrt-v4 tells 2d and 3d vectors apart
+def get_vector_type(textures):
+    return 'vector3' if get_version(textures) >= 4 else 'vector'
+
+
+class TextureRegistry(object):
+    """
+    Textures declared during the export of a material.
+    The node graph is walked depth first so every texture is declared
+    after the textures it depends on, and each node is declared only once
+    per texture type no matter how many sockets it's linked to.
+    Texture subgraphs which only depend on constants are folded into
+    literal parameters instead of being declared.
+    """
+
+    def __init__(self, prefix='', texture_cache=None, version=3):
+        # Texture names are prefixed with the material name to keep them
+        # unique across materials
+        self.prefix = prefix
+        # Converts the images used by image textures, None to use them as they are
+        self.texture_cache = texture_cache
+        # pbrt scene syntax version, 3 or 4
+        self.version = version
+        # Images referenced by the textures
+        self.images = []
+        # (node pointer, texture type) -> declared texture name
+        self.names = {}
+        self.used_names = set()
+        # Nodes on the current path of the walk, used to detect cycles
+        self.visiting = set()
+        # node pointer -> folded rgb value, None if the node isn't constant
+        self.constants = {}
+        # Texture nodes which don't need to be evaluated by pbrt
+        self.eliminated = set()
+        # Materials which lose parameters in their pbrt-v4 counterpart
+        self.warnings = []
+
+    def get_name(self, node, texture_type):
+        name = '{}:{}'.format(self.prefix, node.name) if self.prefix else node.name
+        if name in self.used_names:
+            # Same node used as both a float and a spectrum texture
+            name += ':' + texture_type
+        return name
+
+    # Filepath of an image datablock, packed images get extracted
+    def get_image_filepath(self, image):
+        if self.texture_cache is None:
+            if image.packed_file is not None:
+                raise Exception('Packed image {} needs a texture cache to be extracted into'.format(image.name))
+            return bpy.path.abspath(image.filepath, library=image.library)
+        return self.texture_cache.get_image_filepath(image)
+
+    # Path of an image file to write into the scene
+    def get_image_reference(self, filename):
+        self.images.append(filename)
+        if self.texture_cache is None:
+            return bpy.path.abspath(filename).replace('\\', '/')
+        return self.texture_cache.get_reference(filename)
+
+    # Constant rgb value of a socket, None if it depends on a texture that
+    # can't be folded. Float values are repeated over the three channels.
+    def get_constant(self, sock):
+        if sock.is_linked:
+            return self.fold(sock.links[0].from_node)
+
+        value = sock.default_value
+        if hasattr(value, '__len__'):
+            return tuple(value[:3])
+        return (value, value, value)
+
+    # Constant rgb value of a texture node, None if it's not constant
+    def fold(self, node):
+        key = node.as_pointer()
+        if key in self.constants:
+            return self.constants[key]
+
+        if key in self.visiting:
+            raise Exception('Cycle in node graph at texture node : %s' %node.name)
+
+        self.visiting.add(key)
+        value = node.fold(self) if hasattr(node, 'fold') else None
+        self.visiting.remove(key)
+
+        self.constants[key] = value
+        if value is not None:
+            self.eliminated.add(key)
+        return value
+
+    # Declare the texture of the node unless it's declared already, returns
+    # the name to reference it by
+    def export(self, node, texture_type, file_writer, indent=0):
+        key = (node.as_pointer(), texture_type)
+        if key in self.names:
+            return self.names[key]
+
+        if key in self.visiting:
+            raise Exception('Cycle in node graph at texture node : %s' %node.name)
+
+        # Nodes like a mix with a constant amount of 0 or 1 just pass one of
+        # their inputs through, the input's texture is used directly
+        forward = node.get_forward_socket(self) if hasattr(node, 'get_forward_socket') else None
+        if forward is not None and forward.is_linked:
+            self.visiting.add(key)
+            name = self.export(forward.links[0].from_node, texture_type, file_writer, indent)
+            self.visiting.remove(key)
+
+            self.names[key] = name
+            self.eliminated.add(node.as_pointer())
+            return name
+
+        # pbrt-v4 only has float versions of some textures, their spectrum
+        # version scales white by the float texture
+        if texture_type == 'spectrum' and self.version >= 4 and getattr(node, 'v4_float_only', False):
+            float_name = self.export(node, 'float', file_writer, indent)
+            name = self.get_name(node, texture_type)
+            self.names[key] = name
+            self.used_names.add(name)
+            file_writer.write(indent * '\t' + 'Texture "{}" "spectrum" "scale" "rgb tex" [1 1 1] "texture scale" "{}"\n'.format(
+                name, float_name))
+            return name
+
+        self.visiting.add(key)
+        # Declares the upstream textures before returning the comps
+        comps = node.export_comps(file_writer, self)
+        self.visiting.remove(key)
+
+        name = self.get_name(node, texture_type)
+        self.names[key] = name
+        self.used_names.add(name)
+
+        comps[1:1] = ['"{}"'.format(name), '"{}"'.format(texture_type)]
+        file_writer.write(indent * '\t' + ' '.join(comps) + '\n')
+        return name
+
+
 class PBRTShadingNode(bpy.types.ShaderNode):
     """
     Base class for PBRT shading nodes
@@ -43,6 +185,13 @@ class PBRTShadingNode(bpy.types.ShaderNode):
 
     socket_dict = {}
 
+    # pbrt-v4 name of the node type, None if it's the same as in v3
+    v4_type = None
+    # pbrt-v4 names of the parameters, None if they're the same as in v3.
+    # Parameters left out are not written since pbrt-v4 rejects the ones
+    # it doesn't use.
+    v4_params = None
+
     @classmethod
     def poll(cls, tree: bpy.types.NodeTree):
         return tree.bl_idname in ('ShaderNodeTree', 'PBRTTreeType') and bpy.context.scene.render.engine == 'PBRT_RENDER'
@@ -83,54 +232,84 @@ class PBRTShadingNode(bpy.types.ShaderNode):
 
         return param_dict
 
+    def get_node_type(self, textures=None):
+        if get_version(textures) >= 4 and self.v4_type is not None:
+            return self.v4_type
+        return self.node_type
+
+    # Name of a parameter in the exported syntax, None if it's not written
+    def get_param_name(self, key, textures=None):
+        if get_version(textures) < 4 or self.v4_params is None:
+            return key
+        return self.v4_params.get(key)
+
+    # Add a parameter that isn't a socket, value is the formatted value
+    def append_param(self, comps, textures, param_type, key, value):
+        name = self.get_param_name(key, textures)
+        if name is not None:
+            comps.append('"{} {}" {}'.format(param_type, name, value))
+
+    # Parameter component of a socket, sock_type overrides the type of the
+    # socket, e.g. to write a color socket as a float parameter
+    def socket_comp(self, sock, name, file_writer, textures, sock_type=None):
+        sock_type = sock_type or sock.type
+        if sock_type not in attribute_type_mapping:
+            raise Exception("socket type unsupported : {}".format(sock_type))
+
+        # If socket is linked to a texture graph that isn't constant,
+        # declare the texture through the registry and reference it.
+        # The texture type follows the socket type.
+        value = textures.get_constant(sock)
+        if value is None:
+            from_node = sock.links[0].from_node
+            texture_name = textures.export(from_node, socket_type_mapping[sock_type], file_writer)
+            return '"texture {}" "{}"'.format(name, texture_name)
+
+        # Else write out the attribute value
+        # float type socket
+        if sock_type == 'VALUE':
+            sock_value = '[{}]'.format(fmt(value[0]))
+        # color and vector type socket
+        else:
+            sock_value = '[{}]'.format(fmt_values(value))
+        return '"{} {}" {}'.format(attribute_type_mapping[sock_type], name, sock_value)
+
     # The export line components interface in case some attributes is not defined as a socket
     # Shader nodes containing property attributes need to override this function
-    def export_comps(self, file_writer):
-        shader_line_comps = [self.category]
-
-        # Texture nodes need name and type attribute
-        if self.category == 'Texture':
-            shader_line_comps.append('"{}"'.format(self.name))
-            # Determine texture node type by connected upstream socket type
-            upstream_socket_type = self.outputs['Output'].links[0].to_socket.type
-            shader_line_comps.append('"{}"'.format(socket_type_mapping[upstream_socket_type]))
+    def export_comps(self, file_writer, textures=None):
+        if textures is None:
+            textures = TextureRegistry()
 
-        shader_line_comps.append('"{}"'.format(self.node_type))
+        # Texture nodes get their name and type inserted by the registry
+        shader_line_comps = [self.category, '"{}"'.format(self.get_node_type(textures))]
 
         for key, value in self.socket_dict.items():
             sock = self.inputs[key]
 
-            # If socket is linked, recursively export the node
-            if sock.is_linked:
-                from_node = sock.links[0].from_node
-                from_node.export(0, file_writer)
-                shader_line_comps.append('"texture {}" "{}"'.format(key, from_node.name))
+            # Shader sockets reference named materials, they are written
+            # by export_named of the nodes using them
+            if sock.type == 'SHADER':
+                continue
 
-            # Else write out the attribute value
-            else:
-                # float type socket
-                if sock.type == 'VALUE':
-                    sock_value = '[{}]'.format(sock.default_value)
-                # color type socket
-                elif sock.type == 'RGBA':
-                    rgba_value = sock.default_value
-                    sock_value = '[{} {} {}]'.format(rgba_value[0], rgba_value[1], rgba_value[2])
-                elif sock.type == 'VECTOR':
-                    vec_value = sock.default_value
-                    sock_value = '[{} {} {}]'.format(vec_value[0], vec_value[1], vec_value[2])
-                else:
-                    raise Exception("socket type unsupported : {}".format(sock.type))
-                shader_line_comps.append('"{} {}" {}'.format(attribute_type_mapping[sock.type], key, sock_value))
+            name = self.get_param_name(key, textures)
+            if name is None:
+                continue
+
+            shader_line_comps.append(self.socket_comp(sock, name, file_writer, textures))
 
         return shader_line_comps
 
     # The actual export interface
-    def export(self, indent, file_writer):
-        comps = self.export_comps(file_writer)
+    def export(self, indent, file_writer, textures=None):
+        comps = self.export_comps(file_writer, textures)
         file_writer.write(indent * '\t' + ' '.join(comps) + '\n')
 
 
 class PBRTShaderNode(PBRTShadingNode):
+    # What's lost when the material is written as its pbrt-v4 counterpart,
+    # None if nothing is
+    v4_loss = None
+
     def init(self, context):
         super(PBRTShaderNode, self).init(context)
         self.outputs.new('NodeSocketShader', 'Output')
@@ -138,6 +317,23 @@ class PBRTShaderNode(PBRTShadingNode):
     def draw_buttons(self, context, layout: 'UILayout'):
         pass
 
+    # Turn the Material line components into a MakeNamedMaterial definition
+    def named_comps(self, name, file_writer, textures):
+        if textures.version >= 4 and self.v4_loss is not None:
+            textures.warnings.append('Material "{}" is written as a pbrt-v4 {} material, {}'.format(
+                name, self.get_node_type(textures), self.v4_loss))
+        comps = self.export_comps(file_writer, textures)
+        comps[:2] = ['MakeNamedMaterial "{}" "string type"'.format(name), comps[1]]
+        return comps
+
+    # Export as a named material which is referenced by NamedMaterial and mix
+    # materials, named materials have to be defined before they are used
+    def export_named(self, name, indent, file_writer, textures=None):
+        if textures is None:
+            textures = TextureRegistry(name)
+        comps = self.named_comps(name, file_writer, textures)
+        file_writer.write(indent * '\t' + ' '.join(comps) + '\n')
+
 
 class PBRTShaderNodeWithRemapRoughness(PBRTShaderNode):
     remaproughness = bpy.props.BoolProperty(name="remaproughness",
@@ -152,9 +348,9 @@ class PBRTShaderNodeWithRemapRoughness(PBRTShaderNode):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
+        self.append_param(comps, textures, 'bool', 'remaproughness', '"true"' if self.remaproughness else '"false"')
         return comps
 
 
@@ -164,6 +360,10 @@ class PBRTShaderNodeDisney(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeDisney'
     node_type = 'disney'
+    # pbrt-v4 has no disney material, the base color is kept on a diffuse one
+    v4_type = 'diffuse'
+    v4_params = {'color': 'reflectance'}
+    v4_loss = 'only the disney base color is kept'
 
     socket_dict = {
         'color': ('NodeSocketColor', (0.5, 0.5, 0.5, 1.0)),
@@ -199,9 +399,9 @@ class PBRTShaderNodeDisney(PBRTShaderNode):
         param_dict['params'].update({'thin': self.thin})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'thin', 'true' if self.thin else 'false'))
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
+        self.append_param(comps, textures, 'bool', 'thin', '"true"' if self.thin else '"false"')
         return comps
 
 
@@ -211,6 +411,10 @@ class PBRTShaderNodeFourier(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeFourier'
     node_type = 'fourier'
+    # pbrt-v4 has no fourier bsdfs
+    v4_type = 'diffuse'
+    v4_params = {}
+    v4_loss = 'the fourier bsdf file is ignored'
 
     bsdffile: bpy.props.StringProperty(name="bsdffile",
                                        description="File that stores the Fourier BSDF description")
@@ -225,9 +429,9 @@ class PBRTShaderNodeFourier(PBRTShaderNode):
             'params': {'bsdffile': self.bsdffile}
         }
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('string', 'bsdffile', self.bsdffile))
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
+        self.append_param(comps, textures, 'string', 'bsdffile', '"{}"'.format(self.bsdffile))
         return comps
 
 
@@ -237,6 +441,9 @@ class PBRTShaderNodeGlass(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeGlass'
     node_type = 'glass'
+    v4_type = 'dielectric'
+    v4_params = {'eta': 'eta', 'uroughness': 'uroughness', 'vroughness': 'vroughness',
+                 'remaproughness': 'remaproughness'}
 
     socket_dict = {
         'Kr': ('NodeSocketColor', (1.0, 1.0, 1.0, 1.0)),
@@ -258,11 +465,6 @@ class PBRTShaderNodeGlass(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeHair(PBRTShaderNode):
@@ -270,6 +472,9 @@ class PBRTShaderNodeHair(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeHair'
     node_type = 'hair'
+    v4_params = {'sigma_a': 'sigma_a', 'color': 'reflectance', 'eumelanin': 'eumelanin',
+                 'pheomelanin': 'pheomelanin', 'eta': 'eta', 'beta_m': 'beta_m',
+                 'beta_n': 'beta_n', 'alpha': 'alpha'}
 
     socket_dict = {
         'sigma_a': ('NodeSocketColor', (0, 0, 0, 1)),
@@ -294,9 +499,9 @@ class PBRTShaderNodeHair(PBRTShaderNode):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
+        self.append_param(comps, textures, 'bool', 'remaproughness', '"true"' if self.remaproughness else '"false"')
         return comps
 
 
@@ -306,6 +511,9 @@ class PBRTShaderNodeKdSubsurface(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeKdSubsurface'
     node_type = 'kdsubsurface'
+    v4_type = 'subsurface'
+    v4_params = {'Kd': 'reflectance', 'mfp': 'mfp', 'eta': 'eta', 'uroughness': 'uroughness',
+                 'vroughness': 'vroughness', 'remaproughness': 'remaproughness'}
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.5, 0.5, 0.5, 1.0)),
@@ -329,11 +537,6 @@ class PBRTShaderNodeKdSubsurface(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeMatte(PBRTShaderNode):
@@ -341,6 +544,8 @@ class PBRTShaderNodeMatte(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeMatte'
     node_type = 'matte'
+    v4_type = 'diffuse'
+    v4_params = {'Kd': 'reflectance'}
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.5, 0.5, 0.5, 1.0)),
@@ -354,6 +559,11 @@ class PBRTShaderNodeMetal(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeMetal'
     node_type = 'metal'
+    # roughness is only used without uroughness and vroughness, pbrt-v4
+    # would reject it as unused
+    v4_type = 'conductor'
+    v4_params = {'eta': 'eta', 'k': 'k', 'uroughness': 'uroughness', 'vroughness': 'vroughness',
+                 'remaproughness': 'remaproughness'}
 
     socket_dict = {
         'eta': ('NodeSocketColor', (1.0, 1.0, 1.0, 1.0)),
@@ -375,11 +585,6 @@ class PBRTShaderNodeMetal(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeMirror(PBRTShaderNode):
@@ -387,6 +592,9 @@ class PBRTShaderNodeMirror(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeMirror'
     node_type = 'mirror'
+    # A smooth conductor, its roughness defaults to 0
+    v4_type = 'conductor'
+    v4_params = {'Kr': 'reflectance'}
 
     socket_dict = {
         'Kr': ('NodeSocketColor', 0.9),
@@ -399,6 +607,8 @@ class PBRTShaderNodeMixture(PBRTShaderNode):
 
     class_type = 'PBRTShaderNodeMixture'
     node_type = 'mix'
+    # The amount and the materials are written by export_named for pbrt-v4
+    v4_params = {}
 
     socket_dict = {
         'amount': ('NodeSocketVector', (0.5, 0.5, 0.5)),
@@ -406,6 +616,39 @@ class PBRTShaderNodeMixture(PBRTShaderNode):
         'namedmaterial2': ('NodeSocketShader', None),
     }
 
+    # The linked shaders are defined as named materials called
+    # '<name>.<node name>' first, then referenced by the mix material
+    def export_named(self, name, indent, file_writer, textures=None):
+        # The linked shaders share the textures of the mix material
+        if textures is None:
+            textures = TextureRegistry(name)
+
+        material_names = {}
+        for key in ('namedmaterial1', 'namedmaterial2'):
+            sock = self.inputs[key]
+            if not sock.is_linked:
+                raise Exception('{} of mix material {} is not connected'.format(key, name))
+
+            from_node = sock.links[0].from_node
+            if not hasattr(from_node, 'export_named'):
+                raise Exception('None pbrt material assigned : %s' %from_node.name)
+
+            material_name = '{}.{}'.format(name, from_node.name)
+            if material_name not in material_names.values():
+                from_node.export_named(material_name, indent, file_writer, textures)
+            material_names[key] = material_name
+
+        comps = self.named_comps(name, file_writer, textures)
+        if textures.version >= 4:
+            # pbrt-v4 takes a float amount and both materials in one list
+            comps.append(self.socket_comp(self.inputs['amount'], 'amount', file_writer, textures, 'VALUE'))
+            comps.append('"string materials" [{}]'.format(
+                ' '.join('"{}"'.format(material_names[key]) for key in ('namedmaterial1', 'namedmaterial2'))))
+        else:
+            for key, material_name in material_names.items():
+                comps.append('"string {}" "{}"'.format(key, material_name))
+        file_writer.write(indent * '\t' + ' '.join(comps) + '\n')
+
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodePlastic(PBRTShaderNodeWithRemapRoughness):
@@ -413,6 +656,9 @@ class PBRTShaderNodePlastic(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodePlastic'
     node_type = 'plastic'
+    v4_type = 'coateddiffuse'
+    v4_params = {'Kd': 'reflectance', 'roughness': 'roughness', 'remaproughness': 'remaproughness'}
+    v4_loss = 'Ks is dropped'
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.25, 0.25, 0.25, 1.0)),
@@ -432,11 +678,6 @@ class PBRTShaderNodePlastic(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeSubstrate(PBRTShaderNodeWithRemapRoughness):
@@ -444,6 +685,10 @@ class PBRTShaderNodeSubstrate(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeSubstrate'
     node_type = 'substrate'
+    v4_type = 'coateddiffuse'
+    v4_params = {'Kd': 'reflectance', 'uroughness': 'uroughness', 'vroughness': 'vroughness',
+                 'remaproughness': 'remaproughness'}
+    v4_loss = 'Ks is dropped'
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.5, 0.5, 0.5, 1.0)),
@@ -464,11 +709,6 @@ class PBRTShaderNodeSubstrate(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeSubsurface(PBRTShaderNodeWithRemapRoughness):
@@ -476,6 +716,9 @@ class PBRTShaderNodeSubsurface(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeSubsurface'
     node_type = 'subsurface'
+    v4_params = {'sigma_a': 'sigma_a', 'sigma_prime_s': 'sigma_s', 'eta': 'eta',
+                 'uroughness': 'uroughness', 'vroughness': 'vroughness',
+                 'remaproughness': 'remaproughness', 'name': 'name', 'scale': 'scale'}
 
     socket_dict = {
         'sigma_a': ('NodeSocketVector', (0.0011, 0.0024, 0.014)),
@@ -513,11 +756,10 @@ class PBRTShaderNodeSubsurface(PBRTShaderNodeWithRemapRoughness):
         data_dict['params'].update({'remaproughness': self.remaproughness})
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('string', 'name', self.coefficient_name))
-        comps.append('"{} {}" {}'.format('float scale', self.scale))
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
+        self.append_param(comps, textures, 'string', 'name', '"{}"'.format(self.coefficient_name))
+        self.append_param(comps, textures, 'float', 'scale', fmt(self.scale))
         return comps
 
 
@@ -527,6 +769,8 @@ class PBRTShaderNodeTranslucent(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeTranslucent'
     node_type = 'translucent'
+    v4_type = 'diffusetransmission'
+    v4_params = {'reflect': 'reflectance', 'transmit': 'transmittance'}
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.25, 0.25, 0.25, 1.0)),
@@ -548,11 +792,6 @@ class PBRTShaderNodeTranslucent(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 @PBRTNodeTypes('material')
 class PBRTShaderNodeUber(PBRTShaderNodeWithRemapRoughness):
@@ -560,6 +799,10 @@ class PBRTShaderNodeUber(PBRTShaderNodeWithRemapRoughness):
 
     class_type = 'PBRTShaderNodeUber'
     node_type = 'uber'
+    # pbrt-v4 has no uber material, the diffuse base and its coating are kept
+    v4_type = 'coateddiffuse'
+    v4_params = {'Kd': 'reflectance', 'roughness': 'roughness', 'remaproughness': 'remaproughness'}
+    v4_loss = 'Ks, Kr, Kt, eta, opacity and the anisotropic roughness are dropped'
 
     socket_dict = {
         'Kd': ('NodeSocketColor', (0.25, 0.25, 0.25, 1.0)),
@@ -585,20 +828,28 @@ class PBRTShaderNodeUber(PBRTShaderNodeWithRemapRoughness):
         param_dict['params'].update({'remaproughness': self.remaproughness})
         return param_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        comps.append('"{} {}" "{}"'.format('bool', 'remaproughness', 'true' if self.remaproughness else 'false'))
-        return comps
-
 
 # Texture nodes provides the flexibility of specifying both
 # color and float for a single socket.
 # We don't support this feature for now.
 class PBRTTextureNode(PBRTShadingNode):
+    # Whether pbrt-v4 only has a float version of the texture
+    v4_float_only = False
+
     def init(self, context):
         super(PBRTTextureNode, self).init(context)
         self.outputs.new('NodeSocketColor', 'Output')
 
+    # Textures are declared through a registry, which gives them their name
+    # and type and makes sure they're only declared once
+    def export(self, indent, file_writer, textures=None):
+        if textures is None:
+            textures = TextureRegistry()
+
+        # Determine texture node type by connected upstream socket type
+        upstream_socket_type = self.outputs['Output'].links[0].to_socket.type
+        textures.export(self, socket_type_mapping[upstream_socket_type], file_writer, indent)
+
 
 @PBRTNodeTypes('texture')
 class PBRTTextureNodeConstant(PBRTTextureNode):
@@ -611,6 +862,9 @@ class PBRTTextureNodeConstant(PBRTTextureNode):
         'value': ('NodeSocketColor', (1, 1, 1, 1)),
     }
 
+    def fold(self, textures):
+        return textures.get_constant(self.inputs['value'])
+
     # Currently don't have a convenient way to share the common properties
     mapping: bpy.props.EnumProperty(name="mapping",
                                     items=[
@@ -677,18 +931,21 @@ class PBRTTextureNodeConstant(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super(PBRTTextureNode, self).export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super(PBRTTextureNode, self).export_comps(file_writer, textures)
+        # pbrt-v4's constant texture has no mapping
+        if get_version(textures) >= 4:
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -698,12 +955,21 @@ class PBRTTextureNodeScale(PBRTTextureNode):
 
     class_type = 'PBRTTextureNodeScale'
     node_type = 'scale'
+    # pbrt-v4 scales a texture by a float
+    v4_params = {'tex1': 'tex'}
 
     socket_dict = {
         'tex1': ('NodeSocketColor', (1, 1, 1, 1)),
         'tex2': ('NodeSocketColor', (1, 1, 1, 1)),
     }
 
+    def fold(self, textures):
+        tex1 = textures.get_constant(self.inputs['tex1'])
+        tex2 = textures.get_constant(self.inputs['tex2'])
+        if tex1 is None or tex2 is None:
+            return None
+        return tuple(a * b for a, b in zip(tex1, tex2))
+
     mapping: bpy.props.EnumProperty(name="mapping",
                                     items=[
                                         ("uv", "UV", ""),
@@ -769,18 +1035,24 @@ class PBRTTextureNodeScale(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super(PBRTTextureNode, self).export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        if textures is None:
+            textures = TextureRegistry()
+        comps = super(PBRTTextureNode, self).export_comps(file_writer, textures)
+        # pbrt-v4's scale texture has no mapping
+        if textures.version >= 4:
+            comps.append(self.socket_comp(self.inputs['tex2'], 'scale', file_writer, textures, 'VALUE'))
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -797,6 +1069,25 @@ class PBRTTextureNodeMix(PBRTTextureNode):
         'amount': ('NodeSocketFloat', 0.5),
     }
 
+    # With a constant amount of 0 or 1 the other branch is dead
+    def get_forward_socket(self, textures):
+        amount = textures.get_constant(self.inputs['amount'])
+        if amount is None or amount[0] not in (0, 1):
+            return None
+        return self.inputs['tex2'] if amount[0] == 1 else self.inputs['tex1']
+
+    def fold(self, textures):
+        forward = self.get_forward_socket(textures)
+        if forward is not None:
+            return textures.get_constant(forward)
+
+        amount = textures.get_constant(self.inputs['amount'])
+        tex1 = textures.get_constant(self.inputs['tex1'])
+        tex2 = textures.get_constant(self.inputs['tex2'])
+        if amount is None or tex1 is None or tex2 is None:
+            return None
+        return tuple((1 - amount[0]) * a + amount[0] * b for a, b in zip(tex1, tex2))
+
     mapping: bpy.props.EnumProperty(name="mapping",
                                     items=[
                                         ("uv", "UV", ""),
@@ -862,18 +1153,21 @@ class PBRTTextureNodeMix(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super(PBRTTextureNode, self).export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super(PBRTTextureNode, self).export_comps(file_writer, textures)
+        # pbrt-v4's mix texture has no mapping
+        if get_version(textures) >= 4:
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -956,18 +1250,18 @@ class PBRTTextureNodeBiLerp(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super(PBRTTextureNode, self).export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super(PBRTTextureNode, self).export_comps(file_writer, textures)
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1013,6 +1307,10 @@ class PBRTTextureNodeImageMap(PBRTTextureNode):
                                       description="Vector to define planar mapping",
                                       default=(0, 1, 0))
 
+    image: bpy.props.PointerProperty(name="image",
+                                     description="The image to load, packed images are supported. Takes precedence over filename",
+                                     type=bpy.types.Image)
+
     filename: bpy.props.StringProperty(name="filename",
                                        description="The filename of the image to load",
                                        default="",
@@ -1058,7 +1356,9 @@ class PBRTTextureNodeImageMap(PBRTTextureNode):
                 layout.prop(self, 'v1')
                 layout.prop(self, 'v2')
 
-        layout.prop(self, 'filename')
+        layout.template_ID(self, 'image', open='image.open')
+        if self.image is None:
+            layout.prop(self, 'filename')
         layout.prop(self, 'wrap')
         layout.prop(self, 'maxanisotropy')
         layout.prop(self, 'trilinear')
@@ -1067,6 +1367,7 @@ class PBRTTextureNodeImageMap(PBRTTextureNode):
 
     def get_data_dict(self):
         data_dict = super(PBRTTextureNodeImageMap, self).get_data_dict()
+        data_dict['params']['image'] = self.image.name if self.image else ''
         data_dict['params']['filename'] = self.filename
         data_dict['params']['wrap'] = self.wrap
         data_dict['params']['maxanisotropy'] = self.maxanisotropy
@@ -1085,25 +1386,33 @@ class PBRTTextureNodeImageMap(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
-        # Escape '\' special characters
-        comps.append('"string filename" "{}"'.format( self.filename.replace("\\", "/") ) ) 
+    def export_comps(self, file_writer, textures=None):
+        if textures is None:
+            textures = TextureRegistry()
+        comps = super().export_comps(file_writer, textures)
+        filename = textures.get_image_filepath(self.image) if self.image else self.filename
+        comps.append('"string filename" "{}"'.format(textures.get_image_reference(filename)))
         comps.append('"string wrap" "{}"'.format(self.wrap))
-        comps.append('"float maxanisotropy" {}'.format(self.maxanisotropy))
-        comps.append('"bool trilinear" "{}"'.format('true' if self.trilinear else 'false'))
-        comps.append('"float scale" {}'.format(self.scale))
-        comps.append('"bool gamma" "{}"'.format('true' if self.gamma else 'false'))
+        comps.append('"float maxanisotropy" {}'.format(fmt(self.maxanisotropy)))
+        if textures.version >= 4:
+            # Without trilinear filtering pbrt-v3 uses ewa
+            comps.append('"string filter" "{}"'.format('trilinear' if self.trilinear else 'ewa'))
+            comps.append('"float scale" {}'.format(fmt(self.scale)))
+            comps.append('"string encoding" "{}"'.format('sRGB' if self.gamma else 'linear'))
+        else:
+            comps.append('"bool trilinear" "{}"'.format('true' if self.trilinear else 'false'))
+            comps.append('"float scale" {}'.format(fmt(self.scale)))
+            comps.append('"bool gamma" "{}"'.format('true' if self.gamma else 'false'))
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1198,20 +1507,26 @@ class PBRTTextureNodeCheckerboard(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
         comps.append('"integer dimension" {}'.format(self.dimension))
-        comps.append('"string aamode" "{}"'.format(self.aamode))
+        # pbrt-v4 doesn't antialias checkerboards, and maps 3d ones only by
+        # the object space point
+        if get_version(textures) >= 4:
+            if self.dimension == 3:
+                return comps
+        else:
+            comps.append('"string aamode" "{}"'.format(self.aamode))
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1292,18 +1607,18 @@ class PBRTTextureNodeDots(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super(PBRTTextureNode, self).export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super(PBRTTextureNode, self).export_comps(file_writer, textures)
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1313,6 +1628,7 @@ class PBRTTextureNodeFbm(PBRTTextureNode):
 
     class_type = 'PBRTTextureNodeFbm'
     node_type = 'fbm'
+    v4_float_only = True
 
     octaves: bpy.props.IntProperty(name="octaves",
                                    description="The maximum number of octaves of noise to use in spectral synthesis",
@@ -1392,20 +1708,23 @@ class PBRTTextureNodeFbm(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
         comps.append('"integer octaves" {}'.format(self.octaves))
-        comps.append('"float roughness" {}'.format(self.roughness))
+        comps.append('"float roughness" {}'.format(fmt(self.roughness)))
+        # pbrt-v4's 3d textures are mapped by the object space point only
+        if get_version(textures) >= 4:
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1415,6 +1734,7 @@ class PBRTTextureNodeWrinkled(PBRTTextureNode):
 
     class_type = 'PBRTTextureNodeWrinkled'
     node_type = 'wrinkled'
+    v4_float_only = True
 
     octaves: bpy.props.IntProperty(name="octaves",
                                    description="The maximum number of octaves of noise to use in spectral synthesis",
@@ -1496,20 +1816,23 @@ class PBRTTextureNodeWrinkled(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
         comps.append('"integer octaves" {}'.format(self.octaves))
-        comps.append('"float roughness" {}'.format(self.roughness))
+        comps.append('"float roughness" {}'.format(fmt(self.roughness)))
+        # pbrt-v4's 3d textures are mapped by the object space point only
+        if get_version(textures) >= 4:
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -1614,22 +1937,25 @@ class PBRTTextureNodeMarble(PBRTTextureNode):
                 data_dict['params']['v2'] = (self.v2.x, self.v2.y, self.v2.z)
         return data_dict
 
-    def export_comps(self, file_writer):
-        comps = super().export_comps(file_writer)
+    def export_comps(self, file_writer, textures=None):
+        comps = super().export_comps(file_writer, textures)
         comps.append('"integer octaves" {}'.format(self.octaves))
-        comps.append('"float roughness" {}'.format(self.roughness))
-        comps.append('"float scale" {}'.format(self.scale))
-        comps.append('"float variation" {}'.format(self.variation))
+        comps.append('"float roughness" {}'.format(fmt(self.roughness)))
+        comps.append('"float scale" {}'.format(fmt(self.scale)))
+        comps.append('"float variation" {}'.format(fmt(self.variation)))
+        # pbrt-v4's 3d textures are mapped by the object space point only
+        if get_version(textures) >= 4:
+            return comps
         comps.append('"string mapping" "{}"'.format(self.mapping))
         if self.mapping in ('uv', 'planar'):
-            comps.append('"float udelta" {}'.format(self.udelta))
-            comps.append('"float vdelta" {}'.format(self.vdelta))
+            comps.append('"float udelta" {}'.format(fmt(self.udelta)))
+            comps.append('"float vdelta" {}'.format(fmt(self.vdelta)))
             if self.mapping == 'uv':
-                comps.append('"float uscale" {}'.format(self.uscale))
-                comps.append('"float vscale" {}'.format(self.vscale))
+                comps.append('"float uscale" {}'.format(fmt(self.uscale)))
+                comps.append('"float vscale" {}'.format(fmt(self.vscale)))
             else:
-                comps.append('"vector v1" [{} {} {}]'.format(self.v1.x, self.v1.y, self.v1.z))
-                comps.append('"vector v2" [{} {} {}]'.format(self.v2.x, self.v2.y, self.v2.z))
+                comps.append('"{} v1" [{}]'.format(get_vector_type(textures), fmt_values(self.v1)))
+                comps.append('"{} v2" [{}]'.format(get_vector_type(textures), fmt_values(self.v2)))
         return comps
 
 
@@ -15,11 +15,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import io
 import os
 
 import bpy
+import subprocess
 import time
 
+from . import animation
+from .adaptive import AdaptiveRenderer
+from .driver import PBRTProcess
+from .display import DisplayServer
+from .results import ResultCache
+from .tiles import TileRenderer
+from .tiles import get_workers
+from .viewport import ViewportSession
 from ..sceneio import PBRTExporter
 from ..ui.preferences import get_pref
 
@@ -34,19 +44,23 @@ class PBRTRenderEngine(bpy.types.RenderEngine):
     # Constructor
     def __init__(self):
         self.renderer = None
+        # Interactive viewport render, created by the first view_update
+        self.viewport = None
 
     def __del__(self):
-        pass
+        viewport = getattr(self, 'viewport', None)
+        if viewport is not None:
+            viewport.stop()
 
     def render(self, depsgraph):
-        exporter = PBRTExporter()
-
         # Get executable from preference
         pref = get_pref()
         pbrt_executable = pref.pbrt_location
         cache_folder = pref.pbrt_cache_folder
         use_v4 = pref.pbrt_use_v4
 
+        exporter = PBRTExporter.from_preferences(pref)
+
         # 2021-05-20: Bizarro bug that James couldn't work out:
         # - When rendering stills (F12; Render->Render Image), the current animation 
         # frame works fine and the expected output is produced.
@@ -69,7 +83,6 @@ class PBRTRenderEngine(bpy.types.RenderEngine):
         # Insert framenumber from animation
         filename = filename.replace( '.blend', '_{:04d}.blend'.format(animframe) )
         cache_filepath = os.path.join(cache_folder, filename.replace('.blend', '.pbrt'))
-        converted_cache_filepath = os.path.join(cache_folder, filename.replace('.blend', '_converted.pbrt'))
         outfile = os.path.join(cache_folder, filename.replace('.blend', '.exr'))
 
         # Get film resolution from camera attributes
@@ -77,44 +90,163 @@ class PBRTRenderEngine(bpy.types.RenderEngine):
         x_resolution = render.resolution_x
         y_resolution = render.resolution_y
 
+        # Passes with different seeds need the command line options of pbrt-v4
+        adaptive = bpy.context.scene.pbrt_sampler_props.adaptive and not pref.pbrt_tile_render
+        if adaptive and not use_v4:
+            print('Adaptive sampling needs pbrt-v4, rendering the samples set in the sampler')
+            adaptive = False
+
+        # A streamed scene is exported once pbrt runs, tiles and passes are
+        # rendered from a scene file
+        stream_scene = pref.pbrt_stream_scene and not pref.pbrt_tile_render and not adaptive
+
+        # Renders are looked up by the hash of the exported scene, which
+        # isn't known before a streamed scene is rendered. Adaptive renders
+        # are merged in memory and have no image to store
+        results = None
+        if pref.pbrt_result_cache and not stream_scene and not pref.pbrt_tile_render and not adaptive:
+            results = ResultCache(os.path.join(cache_folder, 'results'), pbrt_executable,
+                                  pref.pbrt_result_cache_size << 20)
+            exporter.hash_scene = True
+
         # Export pbrt cache file
         exp_time = time.time()
-        exporter.export(cache_filepath)
-        exp_elapsed = time.time() - exp_time
-        print( 'Export scene file description time (seconds): {}'.format(exp_elapsed) )
+        if not stream_scene:
+            exporter.export(cache_filepath)
+            exp_elapsed = time.time() - exp_time
+            print( 'Export scene file description time (seconds): {}'.format(exp_elapsed) )
+            self.report_export_warnings(exporter)
+
+        result_key = None
+        if results is not None:
+            result_key = results.get_key(exporter.scene_hash)
+            cached_image = results.lookup(result_key)
+            if cached_image is not None:
+                result = self.begin_result(0, 0, x_resolution, y_resolution)
+                try:
+                    result.layers[0].load_from_file(cached_image)
+                    self.update_stats('', 'pbrt | Loaded from the result cache')
+                    # Tell the user, the render looks like a fresh one otherwise
+                    self.report({'INFO'}, 'pbrt: loaded an earlier render of the same scene from the result cache')
+                finally:
+                    self.end_result(result)
+                return
+
+        log_filepath = os.path.splitext(outfile)[0] + '.log'
 
         try:
+            # The exporter writes the syntax of the pbrt version in use,
+            # without a scene file pbrt reads the scene from stdin
             cmd_comps = [pbrt_executable, '--outfile', outfile]
-            if use_v4:
-                convert_cmd_comps = [pbrt_executable, '--upgrade', cache_filepath, '>', converted_cache_filepath]
-                print('Convert command : ', ' '.join(convert_cmd_comps))
-                os.system(' '.join(convert_cmd_comps))
-                cmd_comps.append(converted_cache_filepath)
-            else:
+            if not stream_scene:
                 cmd_comps.append(cache_filepath)
 
-            print('Render command : ', ' '.join(cmd_comps))
-            os.system(' '.join(cmd_comps))
-
-            # Load rendered picture and display it in the viewport
             result = self.begin_result(0, 0, x_resolution, y_resolution)
-            layer = result.layers[0]
-            layer.load_from_file(outfile)
-            self.end_result(result)
+
+            if pref.pbrt_tile_render:
+                try:
+                    renderer = TileRenderer(get_workers(pref), x_resolution, y_resolution, pref.pbrt_tile_count)
+                    if not renderer.run(self, result, cache_filepath):
+                        print('pbrt render cancelled')
+                finally:
+                    self.end_result(result)
+                return
+
+            if adaptive:
+                try:
+                    renderer = AdaptiveRenderer(pbrt_executable, x_resolution, y_resolution,
+                                                bpy.context.scene.pbrt_sampler_props)
+                    if not renderer.run(self, result, cache_filepath, log_filepath):
+                        print('pbrt render cancelled')
+                finally:
+                    self.end_result(result)
+                return
+
+            # pbrt-v4 can send the image while it's rendering
+            display = None
+            on_poll = None
+            if use_v4 and pref.pbrt_display_server:
+                display = DisplayServer(x_resolution, y_resolution)
+                cmd_comps[1:1] = ['--display-server', '{}:{}'.format(*display.address)]
+                on_poll = lambda: display.update_result(self, result)
+
+            try:
+                render_time = time.time()
+                if stream_scene:
+                    # Relative paths in a streamed scene are resolved from
+                    # the working directory
+                    process = PBRTProcess(cmd_comps, log_filepath, cwd=cache_folder, on_poll=on_poll)
+                    process.start(stdin=subprocess.PIPE)
+                    self.stream_scene(exporter, process, cache_filepath)
+                    self.report_export_warnings(exporter)
+                    print( 'Export scene stream time (seconds): {}'.format(time.time() - exp_time) )
+                    returncode = process.wait(self)
+                else:
+                    process = PBRTProcess(cmd_comps, log_filepath, on_poll=on_poll)
+                    returncode = process.run(self)
+
+                # Time until pbrt finished parsing and started rendering,
+                # compare both export modes with it
+                if process.first_progress_time is not None:
+                    print('Scene ready for rendering after {:.2f}s ({})'.format(
+                        process.first_progress_time - exp_time, 'streamed' if stream_scene else 'scene file'))
+
+                if process.cancelled:
+                    print('pbrt render cancelled')
+                    return
+                if returncode != 0:
+                    self.report({'ERROR'}, 'pbrt failed with exit code {}, see {}'.format(returncode, log_filepath))
+                    return
+
+                # Load rendered picture and display it in the viewport
+                layer = result.layers[0]
+                layer.load_from_file(outfile)
+
+                if results is not None:
+                    results.store(result_key, outfile, time.time() - render_time)
+            finally:
+                # Keeps whatever the display server received when pbrt
+                # didn't finish
+                self.end_result(result)
+                if display is not None:
+                    display.close()
 
         except Exception as e:
             print('execute pbrt command failed:\n', e)
 
+    # Materials exported differently than they were set up, e.g. the ones
+    # pbrt-v4 has no counterpart for
+    def report_export_warnings(self, exporter):
+        for warning in exporter.sceneio.materialio.warnings:
+            self.report({'WARNING'}, 'pbrt: ' + warning)
+
+    # Export the scene into the stdin of a running pbrt process
+    def stream_scene(self, exporter, process, cache_filepath):
+        stream = io.TextIOWrapper(process.process.stdin, encoding='utf-8')
+        try:
+            exporter.export(cache_filepath, stream)
+        except BrokenPipeError:
+            # pbrt stopped reading the scene, its exit code and log tell why
+            pass
+        except Exception:
+            process.terminate()
+            raise
+
     def view_update(self, context, depsgraph):
-        pass
+        if self.viewport is None:
+            self.viewport = ViewportSession()
+        self.viewport.update(self, context, depsgraph)
 
     def view_draw(self, context, depsgraph):
-        pass
+        if self.viewport is not None:
+            self.viewport.draw(self, context, depsgraph)
 
 
 def register():
     bpy.utils.register_class(PBRTRenderEngine)
+    animation.register()
 
 
 def unregister():
+    animation.unregister()
     bpy.utils.unregister_class(PBRTRenderEngine)
\ No newline at end of file
@@ -0,0 +1,143 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+
+import numpy as np
+
+from .driver import PBRTProcess
+from .tiles import read_image
+
+
+# Rec. 709 weights, the noise is measured on the luminance
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722])
+
+# Darker pixels are measured against this, or black pixels would never
+# converge
+MIN_LUMINANCE = 1e-3
+
+
+class AdaptiveRenderer(object):
+    """
+    Renders the scene in passes of a few samples per pixel until it
+    converges.
+    Every pass runs pbrt-v4 with another seed, so the passes are
+    independent estimates of the image. Their running mean is the image
+    and their variance tells how much noise is left in it.
+    """
+
+    def __init__(self, pbrt_executable, width, height, sampler_props):
+        self.pbrt_executable = pbrt_executable
+        self.width = width
+        self.height = height
+        self.pass_samples = sampler_props.pass_samples
+        self.target_error = sampler_props.target_error / 100
+        self.time_budget = sampler_props.time_budget
+        self.max_passes = sampler_props.max_passes
+
+        self.passes = 0
+        self.mean = np.zeros((height, width, 4), dtype=np.float32)
+        # Welford's running mean and sum of squared differences
+        self.luminance_mean = np.zeros((height, width))
+        self.luminance_m2 = np.zeros((height, width))
+        # Mean and 95th percentile of the relative error per pixel
+        self.error = None
+
+    # Merge a rendered pass into the running statistics
+    def add_pass(self, pixels):
+        if pixels.shape[:2] != self.mean.shape[:2]:
+            raise Exception('Pass of size {}x{} doesn\'t match the image'.format(pixels.shape[1], pixels.shape[0]))
+
+        self.passes += 1
+        self.mean += (pixels - self.mean) / self.passes
+
+        luminance = pixels[:, :, :3].astype(np.float64) @ LUMINANCE_WEIGHTS
+        delta = luminance - self.luminance_mean
+        self.luminance_mean += delta / self.passes
+        self.luminance_m2 += delta * (luminance - self.luminance_mean)
+
+        if self.passes > 1:
+            # Standard error of the mean over the passes
+            variance = self.luminance_m2 / (self.passes - 1) / self.passes
+            error = np.sqrt(variance) / np.maximum(np.abs(self.luminance_mean), MIN_LUMINANCE)
+            self.error = (float(error.mean()), float(np.percentile(error, 95)))
+
+    def get_stats(self):
+        stats = 'pbrt | Pass {} | {} spp'.format(self.passes, self.passes * self.pass_samples)
+        if self.error is not None:
+            stats += ' | Rel. error {:.2%} (target {:.2%}), p95 {:.2%}'.format(
+                self.error[0], self.target_error, self.error[1])
+        return stats
+
+    # Keep the noise of the previous passes next to the progress of the
+    # running pass
+    def update_pass_stats(self, engine, process, stats):
+        stats = '{} | Rendering pass {}'.format(stats, self.passes + 1)
+        progress = process.get_progress_stats()
+        if progress is not None:
+            stats += ' | ' + progress
+        engine.update_stats('', stats)
+
+    def is_converged(self):
+        return self.error is not None and self.error[0] <= self.target_error
+
+    def update_result(self, engine, result):
+        result.layers[0].passes['Combined'].rect = np.flipud(self.mean).reshape(-1, 4)
+        engine.update_result(result)
+
+    # Render passes until the image converges, the time budget or the pass
+    # limit runs out. Returns False when cancelled
+    def run(self, engine, result, scene_filepath, log_filepath):
+        root = os.path.splitext(scene_filepath)[0]
+        start_time = time.time()
+
+        while self.passes < self.max_passes:
+            elapsed = time.time() - start_time
+            # Only start a pass that's expected to end within the budget
+            if self.time_budget > 0 and self.passes > 0 and \
+                    elapsed + elapsed / self.passes > self.time_budget:
+                print('Adaptive render stopped by the time budget')
+                break
+
+            outfile = '{}_pass{:03d}.exr'.format(root, self.passes)
+            # Every pass keeps its own log, a failed pass isn't overwritten
+            # by the ones after it
+            pass_log_filepath = '{}.pass{}.log'.format(os.path.splitext(log_filepath)[0], self.passes)
+            cmd_comps = [self.pbrt_executable, '--seed', str(self.passes), '--spp', str(self.pass_samples),
+                         '--outfile', outfile, scene_filepath]
+            stats = self.get_stats()
+            process = PBRTProcess(cmd_comps, pass_log_filepath,
+                                  on_poll=lambda: self.update_pass_stats(engine, process, stats))
+            returncode = process.run(engine)
+            if process.cancelled:
+                return False
+            if returncode != 0:
+                raise Exception('pbrt failed with exit code {}, see {}'.format(returncode, pass_log_filepath))
+
+            self.add_pass(read_image(outfile))
+            os.remove(outfile)
+            self.update_result(engine, result)
+
+            stats = self.get_stats()
+            engine.update_stats('', stats)
+            print(stats)
+            if self.is_converged():
+                break
+
+        print('Adaptive render finished after {} passes in {:.1f}s'.format(self.passes, time.time() - start_time))
+        return True
@@ -0,0 +1,255 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import shutil
+import time
+from collections import deque
+
+import bpy
+
+from .driver import PBRTProcess
+from .driver import POLL_INTERVAL
+from .results import ResultCache
+from ..sceneio import PBRTExporter
+from ..ui.preferences import get_pref
+
+
+# Image formats pbrt picks from the output file extension
+OUTPUT_EXTENSIONS = ('.exr', '.png', '.pfm', '.tga')
+
+# Cores per concurrent frame when the job count is picked automatically,
+# enough to keep the parse and BVH build of a frame from being the bottleneck
+CORES_PER_JOB = 16
+
+
+# Split the cores between the concurrent pbrt processes, returns the number
+# of jobs and the --nthreads of each one
+def get_core_budget(jobs, frame_count):
+    cores = os.cpu_count() or 1
+    if jobs == 0:
+        jobs = max(1, cores // CORES_PER_JOB)
+    jobs = max(1, min(jobs, frame_count))
+    return jobs, max(1, cores // jobs)
+
+
+# Frame image in the scene's output path, with an extension pbrt can write
+def get_frame_filepath(scene, frame):
+    filepath = bpy.path.abspath(scene.render.frame_path(frame=frame))
+    root, ext = os.path.splitext(filepath)
+    if ext.lower() not in OUTPUT_EXTENSIONS:
+        ext = '.exr'
+    return root + ext
+
+
+# Written next to a frame once pbrt finished it, frames with one are skipped
+# when the animation is rendered again with Overwrite turned off
+def get_marker_filepath(outfile):
+    return outfile + '.done'
+
+
+def is_frame_done(outfile):
+    return os.path.exists(outfile) and os.path.exists(get_marker_filepath(outfile))
+
+
+class PBRT_OT_render_animation(bpy.types.Operator):
+    """Render the frame range with several pbrt processes at once"""
+    bl_idname = 'render.pbrt_animation'
+    bl_label = 'Render Animation with pbrt'
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.render.engine == 'PBRT_RENDER'
+
+    def invoke(self, context, event):
+        pref = get_pref()
+        scene = context.scene
+
+        frames = range(scene.frame_start, scene.frame_end + 1, scene.frame_step)
+        if scene.render.use_overwrite:
+            # A frame that fails this time mustn't look finished to a later run
+            for frame in frames:
+                marker = get_marker_filepath(get_frame_filepath(scene, frame))
+                if os.path.exists(marker):
+                    os.remove(marker)
+            self.frames = deque(frames)
+        else:
+            self.frames = deque(f for f in frames if not is_frame_done(get_frame_filepath(scene, f)))
+        skipped = len(frames) - len(self.frames)
+        if skipped:
+            print('Skipping {} frames rendered before'.format(skipped))
+        if not self.frames:
+            self.report({'INFO'}, 'All frames are rendered already')
+            return {'FINISHED'}
+
+        self.pbrt_executable = pref.pbrt_location
+        self.cache_folder = pref.pbrt_cache_folder
+        # Shared by the frames so unchanged meshes are only written once
+        self.exporter = PBRTExporter.from_preferences(pref)
+        # The result cache stores exr files, frames in other formats are
+        # always rendered
+        self.results = None
+        if pref.pbrt_result_cache and get_frame_filepath(scene, scene.frame_start).endswith('.exr'):
+            self.results = ResultCache(os.path.join(self.cache_folder, 'results'), self.pbrt_executable,
+                                       pref.pbrt_result_cache_size << 20)
+            self.exporter.hash_scene = True
+        self.job_count, self.threads = get_core_budget(pref.pbrt_animation_jobs, len(self.frames))
+        print('Rendering {} frames, {} at once with {} threads each'.format(
+            len(self.frames), self.job_count, self.threads))
+
+        # (frame, process, outfile, result cache key) of the running pbrt processes
+        self.jobs = []
+        # Result cache key -> (frame, outfile) of frames waiting for a running
+        # job rendering the same scene, e.g. held frames
+        self.waiting = {}
+        self.total = len(self.frames)
+        self.finished = 0
+        # Frames taken from the result cache
+        self.cached = 0
+        self.failed = []
+        self.start_time = time.time()
+        self.frame_current = scene.frame_current
+
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(POLL_INTERVAL, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            for frame, process, outfile, key in self.jobs:
+                process.terminate()
+            self.jobs = []
+            self.finish(context)
+            self.report({'WARNING'}, 'Animation render cancelled after {} frames'.format(self.finished))
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        self.collect()
+        try:
+            self.schedule(context)
+        except Exception as e:
+            print('export frame failed:\n', e)
+            self.frames.clear()
+
+        if not self.jobs and not self.frames:
+            self.finish(context)
+            if self.failed:
+                self.report({'ERROR'}, 'pbrt failed on frames {}'.format(', '.join(str(f) for f in self.failed)))
+            else:
+                self.report({'INFO'}, 'Rendered {} frames ({} from the result cache), {:.1f} frames per hour'.format(
+                    self.finished, self.cached, self.get_throughput()))
+            return {'FINISHED'}
+
+        context.workspace.status_text_set('pbrt | Frame {}/{} | {} running | {:.1f} frames per hour'.format(
+            self.finished + len(self.failed), self.total, len(self.jobs), self.get_throughput()))
+        return {'PASS_THROUGH'}
+
+    def get_throughput(self):
+        hours = (time.time() - self.start_time) / 3600
+        return self.finished / hours if hours > 0 else 0.0
+
+    # Keeps the render time of the frame for reference
+    def mark_done(self, frame, outfile, elapsed):
+        with open(get_marker_filepath(outfile), 'w') as marker:
+            marker.write('{:.1f}\n'.format(elapsed))
+        self.finished += 1
+        print('Frame {} done, {:.1f} frames per hour'.format(frame, self.get_throughput()))
+
+    # Check the running processes, marks the frames that rendered fine
+    def collect(self):
+        running = []
+        for frame, process, outfile, key in self.jobs:
+            returncode = process.process.poll()
+            if returncode is None:
+                running.append((frame, process, outfile, key))
+                continue
+
+            process.reader.join()
+            waiting = self.waiting.pop(key, []) if key is not None else []
+            if returncode == 0 and os.path.exists(outfile):
+                elapsed = process.progress[2] if process.progress else 0.0
+                self.mark_done(frame, outfile, elapsed)
+                if key is not None:
+                    self.results.store(key, outfile, elapsed)
+                for waiting_frame, waiting_outfile in waiting:
+                    shutil.copyfile(outfile, waiting_outfile)
+                    self.mark_done(waiting_frame, waiting_outfile, 0.0)
+            else:
+                self.failed.append(frame)
+                self.failed += [waiting_frame for waiting_frame, waiting_outfile in waiting]
+                print('Frame {} failed with exit code {}, see {}'.format(frame, returncode, process.log_filepath))
+        self.jobs = running
+
+    # Export frames and start pbrt on them until every job slot is taken,
+    # exporting has to happen here since it needs the main thread
+    def schedule(self, context):
+        scene = context.scene
+        while self.frames and len(self.jobs) < self.job_count:
+            frame = self.frames.popleft()
+            scene.frame_set(frame)
+
+            filename = os.path.basename(bpy.data.filepath) or 'tmp.blend'
+            filename = filename.replace('.blend', '_{:04d}.blend'.format(frame))
+            cache_filepath = os.path.join(self.cache_folder, filename.replace('.blend', '.pbrt'))
+            outfile = get_frame_filepath(scene, frame)
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+
+            self.exporter.export(cache_filepath)
+
+            key = None
+            if self.results is not None:
+                key = self.results.get_key(self.exporter.scene_hash)
+                if key in self.waiting:
+                    self.waiting[key].append((frame, outfile))
+                    continue
+                cached_image = self.results.lookup(key)
+                if cached_image is not None:
+                    print('Frame {} loaded from the result cache'.format(frame))
+                    shutil.copyfile(cached_image, outfile)
+                    self.cached += 1
+                    self.mark_done(frame, outfile, 0.0)
+                    continue
+                self.waiting[key] = []
+
+            cmd_comps = [self.pbrt_executable, '--nthreads', str(self.threads), '--outfile', outfile, cache_filepath]
+            log_filepath = os.path.splitext(cache_filepath)[0] + '.log'
+            process = PBRTProcess(cmd_comps, log_filepath)
+            process.start()
+            self.jobs.append((frame, process, outfile, key))
+
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        context.workspace.status_text_set(None)
+        context.scene.frame_set(self.frame_current)
+
+
+def draw_menu(self, context):
+    if context.scene.render.engine == 'PBRT_RENDER':
+        self.layout.operator(PBRT_OT_render_animation.bl_idname, icon='RENDER_ANIMATION')
+
+
+def register():
+    bpy.utils.register_class(PBRT_OT_render_animation)
+    bpy.types.TOPBAR_MT_render.append(draw_menu)
+
+
+def unregister():
+    bpy.types.TOPBAR_MT_render.remove(draw_menu)
+    bpy.utils.unregister_class(PBRT_OT_render_animation)
@@ -0,0 +1,230 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+
+import socket
+import struct
+import threading
+
+
+#
+# Display server for pbrt-v4's --display-server option.
+#
+# pbrt talks the tev ipc protocol, every message starts with its total
+# length as uint32 (the length field included) followed by a uint8 type.
+# Strings are null terminated and numbers little endian. Only the messages
+# needed to receive an image are handled:
+# - CreateImage: grab focus (bool), image name, width, height (int32),
+#                channel count (int32), channel names
+# - UpdateImageV3: grab focus (bool), image name, channel count (int32),
+#                  channel names, x, y, width, height (int32),
+#                  channel offsets (int64), channel strides (int64), floats
+#
+
+CREATE_IMAGE = 4
+UPDATE_IMAGE_V3 = 6
+
+# Channels of the images pbrt sends which go into the combined pass
+CHANNEL_INDICES = {'R': 0, 'G': 1, 'B': 2, 'A': 3}
+
+
+class MessageReader(object):
+    """
+    Reads the fields of a message payload in order
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.offset = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from(fmt, self.payload, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def read_bool(self):
+        return self.read('<?')[0]
+
+    def read_int32(self):
+        return self.read('<i')[0]
+
+    def read_int64s(self, count):
+        return self.read('<{}q'.format(count))
+
+    def read_string(self):
+        end = self.payload.index(b'\0', self.offset)
+        value = self.payload[self.offset:end].decode('utf-8')
+        self.offset = end + 1
+        return value
+
+    def read_floats(self, count):
+        values = np.frombuffer(self.payload, dtype='<f4', count=count, offset=self.offset)
+        self.offset += count * 4
+        return values
+
+
+def pack_message(message_type, payload):
+    return struct.pack('<IB', len(payload) + 5, message_type) + payload
+
+
+def pack_string(value):
+    return value.encode('utf-8') + b'\0'
+
+
+def pack_create_image(name, width, height, channels):
+    payload = struct.pack('<?', False) + pack_string(name)
+    payload += struct.pack('<iii', width, height, len(channels))
+    payload += b''.join(pack_string(channel) for channel in channels)
+    return pack_message(CREATE_IMAGE, payload)
+
+
+# pixels is a (height, width, channels) array of the tile at x, y, with
+# the first row at the top
+def pack_update_image(name, channels, x, y, pixels):
+    height, width, channel_count = pixels.shape
+    payload = struct.pack('<?', False) + pack_string(name)
+    payload += struct.pack('<i', channel_count)
+    payload += b''.join(pack_string(channel) for channel in channels)
+    payload += struct.pack('<iiii', x, y, width, height)
+    payload += struct.pack('<{}q'.format(channel_count), *range(channel_count))
+    payload += struct.pack('<{}q'.format(channel_count), *[channel_count] * channel_count)
+    payload += np.ascontiguousarray(pixels, dtype='<f4').tobytes()
+    return pack_message(UPDATE_IMAGE_V3, payload)
+
+
+def receive_exactly(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class DisplayServer(object):
+    """
+    Receives the in progress image pbrt sends to its display server into
+    a buffer, which gets pushed into the render result of the engine.
+    Connections are served on background threads, the render result is
+    only touched from the thread calling update_result.
+    """
+
+    def __init__(self, width, height, host='127.0.0.1', port=0):
+        self.width = width
+        self.height = height
+        # rgba pixels with the first row at the top like pbrt sends them
+        self.pixels = np.zeros((height, width, 4), dtype=np.float32)
+        self.pixels[:, :, 3] = 1
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.closed = False
+
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while not self.closed:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        with connection:
+            while True:
+                header = receive_exactly(connection, 4)
+                if header is None:
+                    break
+                length = struct.unpack('<I', header)[0]
+                message = receive_exactly(connection, length - 4)
+                if message is None:
+                    break
+                self.handle_message(message[0], MessageReader(message[1:]))
+
+    def handle_message(self, message_type, reader):
+        # Image creation only tells the size and channels, which are sent
+        # with every update again
+        if message_type != UPDATE_IMAGE_V3:
+            return
+
+        reader.read_bool()
+        reader.read_string()
+        channel_count = reader.read_int32()
+        channels = [reader.read_string() for i in range(channel_count)]
+        x, y, width, height = reader.read('<iiii')
+        offsets = reader.read_int64s(channel_count)
+        strides = reader.read_int64s(channel_count)
+
+        pixel_count = width * height
+        value_count = max(offset + (pixel_count - 1) * stride + 1 for offset, stride in zip(offsets, strides))
+        values = reader.read_floats(value_count)
+
+        # Clip the tile to the image
+        x_end = min(x + width, self.width)
+        y_end = min(y + height, self.height)
+        if x_end <= x or y_end <= y:
+            return
+
+        with self.lock:
+            for channel, offset, stride in zip(channels, offsets, strides):
+                if channel not in CHANNEL_INDICES:
+                    continue
+                tile = values[offset:offset + pixel_count * stride:stride].reshape(height, width)
+                self.pixels[y:y_end, x:x_end, CHANNEL_INDICES[channel]] = tile[:y_end - y, :x_end - x]
+            self.dirty = True
+
+    # Copy of the received pixels with the rows bottom up like blender
+    # stores them, None if nothing changed since the last call
+    def get_pixels(self):
+        if not self.dirty:
+            return None
+
+        with self.lock:
+            self.dirty = False
+            return np.flipud(self.pixels).copy()
+
+    # Push the received pixels into the render result if anything changed
+    def update_result(self, engine, result):
+        pixels = self.get_pixels()
+        if pixels is None:
+            return
+
+        result.layers[0].passes['Combined'].rect = pixels.reshape(-1, 4)
+        engine.update_result(result)
+
+    def close(self):
+        self.closed = True
+        self.server.close()
+
+
+# Replays a render to a display server the way pbrt does, tile by tile,
+# to try the display without running pbrt
+def send_fake_render(address, width, height, tile_size=32, name='fake.exr'):
+    channels = ['R', 'G', 'B']
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.dstack((u / max(width - 1, 1), v / max(height - 1, 1), np.full_like(u, 0.5)))
+
+    with socket.create_connection(address) as connection:
+        connection.sendall(pack_create_image(name, width, height, channels))
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                tile = pixels[y:y + tile_size, x:x + tile_size]
+                connection.sendall(pack_update_image(name, channels, x, y, tile))
@@ -0,0 +1,143 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+import subprocess
+import threading
+import time
+
+
+# pbrt's progress bar, e.g. 'Rendering: [+++++     ]  (1.5s|3.0s)', the
+# remaining time is missing once it's done
+progress_pattern = re.compile(r'(\w[\w ]*): \[([+ ]+)\]\s*\(([\d.]+)s(?:\|([\d.]+)s)?\)')
+
+# How often the render engine is checked for cancellation, in seconds
+POLL_INTERVAL = 0.1
+
+# Time pbrt gets to exit after being terminated before it's killed
+TERMINATE_TIMEOUT = 0.5
+
+
+class PBRTProcess(object):
+    """
+    Runs pbrt in a subprocess.
+    Its output is read on a separate thread, progress bar updates are
+    forwarded to the render engine and everything else goes into a log file.
+    The process is terminated as soon as the render engine is cancelled.
+    """
+
+    def __init__(self, cmd_comps, log_filepath, cwd=None, on_poll=None):
+        self.cmd_comps = cmd_comps
+        self.log_filepath = log_filepath
+        self.cwd = cwd
+        # Called on the engine's thread while pbrt runs, e.g. to push the
+        # pixels received by a display server
+        self.on_poll = on_poll
+        self.process = None
+        self.reader = None
+        # Latest (title, fraction, elapsed, remaining) read from the progress bar
+        self.progress = None
+        # When the first progress bar showed up, i.e. the scene was parsed
+        self.first_progress_time = None
+        self.cancelled = False
+
+    def start(self, stdin=None):
+        print('Render command : ', subprocess.list2cmdline(self.cmd_comps))
+        self.process = subprocess.Popen(self.cmd_comps, cwd=self.cwd, stdin=stdin,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self):
+        with open(self.log_filepath, 'w', encoding='utf-8') as log_file:
+            log_file.write(subprocess.list2cmdline(self.cmd_comps) + '\n\n')
+
+            pending = ''
+            while True:
+                data = self.process.stdout.read1(4096)
+                if not data:
+                    break
+
+                # The progress bar redraws itself with carriage returns
+                pending += data.decode('utf-8', errors='replace').replace('\r\n', '\n')
+                segments = re.split(r'([\r\n])', pending)
+                pending = segments.pop()
+                for segment in segments[::2]:
+                    if not self.parse_progress(segment) and segment.strip():
+                        log_file.write(segment + '\n')
+                        log_file.flush()
+
+            if pending and not self.parse_progress(pending):
+                log_file.write(pending + '\n')
+
+    def parse_progress(self, segment):
+        match = progress_pattern.search(segment)
+        if match is None:
+            return False
+
+        if self.first_progress_time is None:
+            self.first_progress_time = time.time()
+        title, bar, elapsed, remaining = match.groups()
+        fraction = bar.count('+') / len(bar)
+        self.progress = (title, fraction, float(elapsed), float(remaining) if remaining else 0.0)
+        return True
+
+    # Progress and time estimates of the latest progress bar, None before
+    # the first one
+    def get_progress_stats(self):
+        if self.progress is None:
+            return None
+
+        return '{}: {:.0%} | Elapsed {:.1f}s | Remaining {:.1f}s'.format(*self.progress)
+
+    def update_engine(self, engine):
+        if self.progress is None:
+            return
+
+        engine.update_progress(self.progress[1])
+        engine.update_stats('', 'pbrt | ' + self.get_progress_stats())
+
+    def terminate(self):
+        self.cancelled = True
+        self.process.terminate()
+        try:
+            self.process.wait(TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    # Wait for pbrt to finish while keeping the engine updated, must be
+    # called from the thread the engine runs on. Returns the exit code.
+    def wait(self, engine):
+        while self.process.poll() is None:
+            if engine.test_break():
+                self.terminate()
+                break
+            self.update_engine(engine)
+            if self.on_poll is not None:
+                self.on_poll()
+            time.sleep(POLL_INTERVAL)
+
+        self.reader.join()
+        self.update_engine(engine)
+        if self.on_poll is not None:
+            self.on_poll()
+        return self.process.returncode
+
+    def run(self, engine):
+        self.start()
+        return self.wait(engine)
@@ -0,0 +1,154 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+
+
+# Bump this whenever the key or the layout of the entries changes
+RESULT_CACHE_VERSION = 1
+
+# (pbrt executable, modification time) -> version line it prints
+pbrt_versions = {}
+
+
+# Version pbrt reports about itself, 'unknown' when it doesn't tell, e.g.
+# pbrt-v3 has no --version option
+def get_pbrt_version(pbrt_executable):
+    try:
+        key = (pbrt_executable, os.stat(pbrt_executable).st_mtime_ns)
+    except OSError:
+        return 'unknown'
+
+    if key not in pbrt_versions:
+        version = 'unknown'
+        try:
+            output = subprocess.run([pbrt_executable, '--version'], capture_output=True, text=True, timeout=10)
+            lines = output.stdout.strip().splitlines()
+            if output.returncode == 0 and lines:
+                version = lines[0]
+        except (OSError, subprocess.SubprocessError):
+            pass
+        pbrt_versions[key] = version
+    return pbrt_versions[key]
+
+
+class ResultCache(object):
+    """
+    Rendered images stored by a hash of everything that goes into the
+    render: the exported scene, the files it references and the pbrt
+    executable. Each entry is an exr file and a json file with its metadata,
+    the least recently used entries are evicted once the cache is larger
+    than max_size bytes.
+    """
+
+    def __init__(self, folder, pbrt_executable, max_size=0):
+        self.folder = folder
+        self.pbrt_executable = pbrt_executable
+        self.pbrt_version = get_pbrt_version(pbrt_executable)
+        # 0 for no limit
+        self.max_size = max_size
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_key(self, scene_hash):
+        hasher = hashlib.blake2b(digest_size=16)
+        try:
+            pbrt_mtime = os.stat(self.pbrt_executable).st_mtime_ns
+        except OSError:
+            pbrt_mtime = 0
+        hasher.update('v{}:{}:{}:{}:{}'.format(RESULT_CACHE_VERSION, scene_hash, self.pbrt_executable,
+                                               pbrt_mtime, self.pbrt_version).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def get_paths(self, key):
+        root = os.path.join(self.folder, key)
+        return root + '.exr', root + '.json'
+
+    # Image rendered for the key before, None if there's none
+    def lookup(self, key):
+        image_path, metadata_path = self.get_paths(key)
+        try:
+            with open(metadata_path, 'r') as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(image_path):
+            return None
+
+        metadata['last_used'] = time.time()
+        metadata['hits'] = metadata.get('hits', 0) + 1
+        self.write_metadata(metadata_path, metadata)
+        print('Result cache hit, rendered by {} in {:.1f}s'.format(metadata.get('pbrt_version', 'unknown'),
+                                                                  metadata.get('render_time', 0)))
+        return image_path
+
+    def store(self, key, image_path, render_time):
+        target_image_path, metadata_path = self.get_paths(key)
+        temp_image_path = target_image_path + '.tmp'
+        shutil.copyfile(image_path, temp_image_path)
+        os.replace(temp_image_path, target_image_path)
+
+        now = time.time()
+        self.write_metadata(metadata_path, {
+            'pbrt': self.pbrt_executable,
+            'pbrt_version': self.pbrt_version,
+            'render_time': render_time,
+            'created': now,
+            'last_used': now,
+            'hits': 0,
+            'size': os.path.getsize(target_image_path),
+        })
+        self.evict()
+
+    def write_metadata(self, metadata_path, metadata):
+        temp_metadata_path = metadata_path + '.tmp'
+        with open(temp_metadata_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=1)
+        os.replace(temp_metadata_path, metadata_path)
+
+    # Remove the least recently used entries until the cache fits into max_size
+    def evict(self):
+        if self.max_size <= 0:
+            return
+
+        entries = []
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.json'):
+                continue
+            key = filename[:-len('.json')]
+            try:
+                with open(os.path.join(self.folder, filename), 'r') as metadata_file:
+                    metadata = json.load(metadata_file)
+                entries.append((metadata['last_used'], metadata['size'], key))
+            except (OSError, ValueError, KeyError):
+                # Half written or foreign entry, get rid of it
+                entries.append((0, 0, key))
+
+        total = sum(size for last_used, size, key in entries)
+        for last_used, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            for path in self.get_paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+            print('Result cache evicted {}'.format(key))
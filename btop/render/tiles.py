@@ -0,0 +1,284 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import math
+import os
+import posixpath
+import shlex
+import subprocess
+import time
+from collections import deque
+
+import numpy as np
+
+from .driver import PBRTProcess
+from .driver import POLL_INTERVAL
+
+# OpenImageIO reads the data window of cropped exr files, without it the
+# tiles are loaded through Blender
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+
+# A tile is given up on after failing this many times, on any worker
+MAX_TILE_ATTEMPTS = 3
+
+
+# Split the image into tile_count boxes (x0, x1, y0, y1) of pixels, fewer
+# only if the image has fewer pixels. Rows go top down like pbrt's crop
+# window, the tile count is spread over them so boxes stay about square.
+def split_tiles(width, height, tile_count):
+    tile_count = max(1, min(tile_count, width * height))
+    rows = max(1, min(height, tile_count, int(round(math.sqrt(tile_count * height / width)))))
+    ys = [height * j // rows for j in range(rows + 1)]
+    tiles = []
+    for j in range(rows):
+        columns = min(width, tile_count // rows + (1 if j < tile_count % rows else 0))
+        xs = [width * i // columns for i in range(columns + 1)]
+        tiles += [(xs[i], xs[i + 1], ys[j], ys[j + 1]) for i in range(columns)]
+    return tiles
+
+
+# Crop window covering exactly the pixels of a box. pbrt rounds the crop
+# window up to pixels, the half pixel offset keeps float error from
+# shifting the boundary by one
+def get_cropwindow(box, width, height):
+    x0, x1, y0, y1 = box
+    comps = (max(0, x0 - 0.5) / width, max(0, x1 - 0.5) / width,
+             max(0, y0 - 0.5) / height, max(0, y1 - 0.5) / height)
+    return ['{:.9g}'.format(c) for c in comps]
+
+
+# Rgba pixels of a rendered image, rows top down
+def read_image(filepath):
+    if oiio is not None:
+        buf = oiio.ImageBuf(filepath)
+        pixels = buf.get_pixels(oiio.FLOAT)
+        if pixels is None or buf.has_error:
+            raise Exception('Failed to read image {}: {}'.format(filepath, buf.geterror()))
+        pixels = pixels.reshape(buf.spec().height, buf.spec().width, -1)
+    else:
+        from .viewport import load_pixels
+        pixels = np.flipud(load_pixels(filepath))
+
+    if pixels.shape[2] == 3:
+        alpha = np.ones(pixels.shape[:2] + (1,), dtype=pixels.dtype)
+        pixels = np.concatenate((pixels, alpha), axis=2)
+    return pixels[:, :, :4]
+
+
+# Copy a tile into the full image. Depending on the pbrt version and the
+# image reader the tile comes either cropped or as a full frame
+def place_tile(canvas, pixels, box):
+    x0, x1, y0, y1 = box
+    if pixels.shape[:2] == canvas.shape[:2]:
+        canvas[y0:y1, x0:x1] = pixels[y0:y1, x0:x1]
+    elif pixels.shape[:2] == (y1 - y0, x1 - x0):
+        canvas[y0:y1, x0:x1] = pixels
+    else:
+        raise Exception('Tile of size {}x{} doesn\'t match {}'.format(pixels.shape[1], pixels.shape[0], box))
+
+
+class LocalTransport(object):
+    """
+    Renders tiles with a pbrt process on this machine.
+    A transport copies the scene to its worker, starts pbrt on a tile and
+    brings the rendered image back, other transports only need the same
+    prepare/start/fetch methods.
+    """
+
+    def __init__(self, pbrt_executable, threads=0, name='local'):
+        self.pbrt_executable = pbrt_executable
+        self.threads = threads
+        self.name = name
+
+    def prepare(self, scene_folder):
+        pass
+
+    # Start pbrt on a tile, returns the running PBRTProcess
+    def start(self, scene_filepath, cropwindow, outfile, log_filepath):
+        cmd_comps = [self.pbrt_executable]
+        if self.threads > 0:
+            cmd_comps += ['--nthreads', str(self.threads)]
+        cmd_comps += ['--cropwindow'] + cropwindow + ['--outfile', outfile, scene_filepath]
+        process = PBRTProcess(cmd_comps, log_filepath)
+        process.start()
+        return process
+
+    # Make the image written by a finished tile available at outfile
+    def fetch(self, outfile):
+        pass
+
+
+class SSHTransport(object):
+    """
+    Renders tiles on a remote host reached through ssh.
+    The cache folder is mirrored into remote_folder with rsync, so scene
+    files must only reference files inside of it.
+    """
+
+    def __init__(self, host, pbrt_executable='pbrt', remote_folder='/tmp/btop'):
+        self.host = host
+        self.pbrt_executable = pbrt_executable
+        self.remote_folder = remote_folder
+        self.name = host
+        self.scene_folder = None
+
+    def get_remote_path(self, filepath):
+        relpath = os.path.relpath(filepath, self.scene_folder)
+        return posixpath.join(self.remote_folder, *relpath.split(os.sep))
+
+    def prepare(self, scene_folder):
+        self.scene_folder = scene_folder
+        subprocess.run(['ssh', '-o', 'BatchMode=yes', self.host, 'mkdir -p ' + shlex.quote(self.remote_folder)],
+                       check=True)
+        subprocess.run(['rsync', '-a', '--exclude', '*.exr', '--exclude', '*.log',
+                        scene_folder.rstrip(os.sep) + os.sep, '{}:{}/'.format(self.host, self.remote_folder)],
+                       check=True)
+
+    def start(self, scene_filepath, cropwindow, outfile, log_filepath):
+        remote_comps = [self.pbrt_executable, '--cropwindow'] + cropwindow + [
+            '--outfile', self.get_remote_path(outfile), self.get_remote_path(scene_filepath)]
+        remote_cmd = 'cd {} && {}'.format(shlex.quote(self.remote_folder),
+                                          ' '.join(shlex.quote(c) for c in remote_comps))
+        # A terminal makes the remote pbrt exit along with the connection
+        # when the render is cancelled
+        process = PBRTProcess(['ssh', '-tt', '-o', 'BatchMode=yes', self.host, remote_cmd], log_filepath)
+        process.start()
+        return process
+
+    def fetch(self, outfile):
+        subprocess.run(['scp', '-q', '-B', '{}:{}'.format(self.host, self.get_remote_path(outfile)), outfile],
+                       check=True)
+
+
+# Transports of the workers set in the preferences, cores of this machine
+# are split between the local workers
+def get_workers(pref):
+    workers = []
+    local_count = pref.pbrt_local_workers
+    threads = max(1, (os.cpu_count() or 1) // local_count) if local_count > 1 else 0
+    for i in range(local_count):
+        workers.append(LocalTransport(pref.pbrt_location, threads, 'local{}'.format(i)))
+    for host in pref.pbrt_remote_hosts.split(','):
+        host = host.strip()
+        if host:
+            workers.append(SSHTransport(host, remote_folder=pref.pbrt_remote_folder))
+    return workers
+
+
+class TileRenderer(object):
+    """
+    Renders a frame as crop window tiles spread over a pool of workers.
+    Every idle worker takes the next tile, failed tiles go back into the
+    queue to be picked up by any worker and finished tiles are stitched
+    into the render result as they come in.
+    """
+
+    def __init__(self, workers, width, height, tile_count):
+        self.workers = workers
+        self.width = width
+        self.height = height
+        self.tiles = split_tiles(width, height, tile_count)
+        # Rgba pixels of the stitched image, rows top down
+        self.canvas = np.zeros((height, width, 4), dtype=np.float32)
+
+    def prepare_workers(self, scene_folder):
+        ready = []
+        for worker in self.workers:
+            try:
+                worker.prepare(scene_folder)
+                ready.append(worker)
+            except Exception as e:
+                print('Worker {} is not available:\n'.format(worker.name), e)
+        if not ready:
+            raise Exception('No worker is available to render tiles')
+        return ready
+
+    def update_result(self, engine, result):
+        result.layers[0].passes['Combined'].rect = np.flipud(self.canvas).reshape(-1, 4)
+        engine.update_result(result)
+
+    # Render every tile of the scene, returns False when cancelled
+    def run(self, engine, result, scene_filepath):
+        scene_folder = os.path.dirname(scene_filepath)
+        root = os.path.splitext(scene_filepath)[0]
+        start_time = time.time()
+
+        idle = self.prepare_workers(scene_folder)
+        pending = deque(range(len(self.tiles)))
+        attempts = [0] * len(self.tiles)
+        # worker -> (tile index, process, outfile)
+        running = {}
+        tile_counts = {worker.name: 0 for worker in idle}
+        done = 0
+
+        try:
+            while pending or running:
+                if engine.test_break():
+                    for index, process, outfile in running.values():
+                        process.terminate()
+                    running = {}
+                    return False
+
+                while pending and idle:
+                    worker = idle.pop()
+                    index = pending.popleft()
+                    outfile = '{}_tile{:03d}.exr'.format(root, index)
+                    cropwindow = get_cropwindow(self.tiles[index], self.width, self.height)
+                    process = worker.start(scene_filepath, cropwindow, outfile, os.path.splitext(outfile)[0] + '.log')
+                    running[worker] = (index, process, outfile)
+
+                for worker, (index, process, outfile) in list(running.items()):
+                    returncode = process.process.poll()
+                    if returncode is None:
+                        continue
+
+                    process.reader.join()
+                    del running[worker]
+                    idle.append(worker)
+                    try:
+                        if returncode != 0:
+                            raise Exception('pbrt exited with code {}, see {}'.format(returncode, process.log_filepath))
+                        worker.fetch(outfile)
+                        place_tile(self.canvas, read_image(outfile), self.tiles[index])
+                    except Exception as e:
+                        attempts[index] += 1
+                        print('Tile {} failed on {}:\n'.format(index, worker.name), e)
+                        if attempts[index] >= MAX_TILE_ATTEMPTS:
+                            raise Exception('Tile {} failed {} times'.format(index, attempts[index]))
+                        pending.append(index)
+                        continue
+
+                    done += 1
+                    tile_counts[worker.name] += 1
+                    self.update_result(engine, result)
+
+                engine.update_progress(done / len(self.tiles))
+                engine.update_stats('', 'pbrt | Tiles {}/{} | {} workers busy'.format(
+                    done, len(self.tiles), len(running)))
+                time.sleep(POLL_INTERVAL)
+        finally:
+            for index, process, outfile in running.values():
+                process.terminate()
+
+        elapsed = time.time() - start_time
+        print('Rendered {} tiles in {:.1f}s, per worker: {}'.format(
+            len(self.tiles), elapsed, ', '.join('{} {}'.format(k, v) for k, v in tile_counts.items())))
+        return True
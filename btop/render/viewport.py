@@ -0,0 +1,236 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bpy
+import mathutils
+import numpy as np
+
+import math
+import os
+
+from functools import partial
+
+from .driver import PBRTProcess
+from .driver import POLL_INTERVAL
+from .display import DisplayServer
+from ..sceneio import PBRTExporter
+from ..ui.preferences import get_pref
+
+
+# Blender's viewport uses twice the default sensor width of 36mm
+VIEWPORT_SENSOR_WIDTH = 72
+
+
+# Load the rgba pixels of a rendered image, rows bottom up
+def load_pixels(filepath):
+    image = bpy.data.images.load(filepath, check_existing=False)
+    try:
+        width, height = image.size
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+    finally:
+        bpy.data.images.remove(image)
+    return pixels.reshape(height, width, 4)
+
+
+class ViewportSession(object):
+    """
+    Interactive rendering of the 3d viewport.
+    The scene is exported once and then again on every depsgraph update,
+    meshes of objects which didn't change are not read again and materials
+    come from the material cache. Navigating the view only rewrites the
+    camera and keeps the exported world block. pbrt runs in the background with a lower
+    resolution and sample count, a run is cancelled as soon as it's stale.
+    """
+
+    def __init__(self):
+        self.exporter = None
+        self.process = None
+        self.display = None
+        # Names of the objects changed since the last export, None to export everything
+        self.changed_objects = None
+        self.view_key = None
+        # Whether the world block needs to be exported again
+        self.scene_changed = True
+        # Files of different sessions in the same cache folder are kept apart
+        self.file_prefix = 'viewport_{:x}'.format(id(self))
+
+        # Newest rendered rgba pixels, rows bottom up
+        self.pixels = None
+        self.version = 0
+        self.texture = None
+        self.texture_version = -1
+
+    # (matrix_world, angle, resolution, ortho scale) to render the viewport
+    # with, the ortho scale is None for perspective views
+    def get_view(self, context):
+        pref = get_pref()
+        region = context.region
+        region_data = context.region_data
+        resolution = (max(1, int(region.width * pref.pbrt_viewport_scale)),
+                      max(1, int(region.height * pref.pbrt_viewport_scale)))
+
+        camera = context.scene.camera
+        if region_data.view_perspective == 'CAMERA' and camera is not None:
+            ortho_scale = camera.data.ortho_scale if camera.data.type == 'ORTHO' else None
+            return camera.matrix_world.copy(), camera.data.angle, resolution, ortho_scale
+
+        space = context.space_data
+        angle = 2 * math.atan(VIEWPORT_SENSOR_WIDTH / 2 / space.lens)
+        if region_data.is_perspective:
+            return region_data.view_matrix.inverted(), angle, resolution, None
+
+        # Orthographic views also show what's behind the view position,
+        # Blender clips them at half the clip end in front of it
+        matrix = region_data.view_matrix.inverted() @ mathutils.Matrix.Translation((0, 0, space.clip_end / 2))
+        return matrix, angle, resolution, region_data.view_distance * VIEWPORT_SENSOR_WIDTH / space.lens
+
+    def get_view_key(self, view):
+        return tuple(tuple(row) for row in view[0]), view[1], view[2], view[3]
+
+    def collect_changes(self, depsgraph):
+        if self.changed_objects is None:
+            return
+
+        for update in depsgraph.updates:
+            if isinstance(update.id, bpy.types.Object) and update.is_updated_geometry:
+                self.changed_objects.add(update.id.name)
+            elif isinstance(update.id, bpy.types.Mesh):
+                for object in depsgraph.objects:
+                    if object.data is not None and object.data.name == update.id.name:
+                        self.changed_objects.add(object.name)
+
+    # Called from view_update
+    def update(self, engine, context, depsgraph):
+        view = self.get_view(context)
+        view_key = self.get_view_key(view)
+        if self.process is not None and len(depsgraph.updates) == 0 and view_key == self.view_key:
+            return
+
+        if len(depsgraph.updates) > 0:
+            self.scene_changed = True
+        self.collect_changes(depsgraph)
+        self.stop()
+        self.start(engine, view)
+        self.view_key = view_key
+
+    def start(self, engine, view):
+        pref = get_pref()
+        cache_folder = pref.pbrt_cache_folder
+        scene_filepath = os.path.join(cache_folder, self.file_prefix + '.pbrt')
+        world_filepath = os.path.join(cache_folder, self.file_prefix + '_world.pbrt')
+        outfile = os.path.join(cache_folder, self.file_prefix + '.exr')
+
+        if self.exporter is None:
+            # Shapes always go through the geometry cache so unchanged
+            # meshes can be skipped
+            self.exporter = PBRTExporter.from_preferences(pref)
+            self.exporter.mesh_format = 'ply'
+            self.exporter.use_geometry_cache = True
+            self.exporter.sceneio.viewport = True
+
+        # The pbrt binary can be switched while the viewport renders
+        version = 4 if pref.pbrt_use_v4 else 3
+        if version != self.exporter.version or not os.path.exists(world_filepath):
+            self.scene_changed = True
+        self.exporter.version = version
+        self.exporter.cameraio.view = view
+        self.exporter.filmio.resolution = view[2]
+        self.exporter.samplerio.pixel_samples = pref.pbrt_viewport_samples
+        if self.scene_changed:
+            self.exporter.changed_objects = self.changed_objects
+            self.exporter.export(scene_filepath, world_path=world_filepath)
+            self.changed_objects = set()
+            self.scene_changed = False
+        else:
+            self.exporter.export_options(scene_filepath, world_filepath)
+
+        cmd_comps = [pref.pbrt_location, '--outfile', outfile]
+        if pref.pbrt_use_v4:
+            self.display = DisplayServer(*view[2])
+            cmd_comps += ['--display-server', '{}:{}'.format(*self.display.address)]
+        cmd_comps.append(scene_filepath)
+
+        self.process = PBRTProcess(cmd_comps, os.path.join(cache_folder, self.file_prefix + '.log'))
+        self.process.start()
+        bpy.app.timers.register(partial(self.poll, engine, self.process, outfile), first_interval=POLL_INTERVAL)
+
+    # Timer checking on a pbrt run, stops once the run is done or stale
+    def poll(self, engine, process, outfile):
+        if process is not self.process:
+            return None
+
+        running = process.process.poll() is None
+        updated = False
+        if self.display is not None:
+            pixels = self.display.get_pixels()
+            if pixels is not None:
+                self.set_pixels(pixels)
+                updated = True
+
+        if not running:
+            process.reader.join()
+            if self.display is None and not process.cancelled and process.process.returncode == 0:
+                self.set_pixels(load_pixels(outfile))
+                updated = True
+
+        try:
+            if updated:
+                engine.tag_redraw()
+        except ReferenceError:
+            # The engine is gone already
+            self.stop()
+            return None
+
+        return POLL_INTERVAL if running else None
+
+    def set_pixels(self, pixels):
+        self.pixels = pixels
+        self.version += 1
+
+    # Called from view_draw
+    def draw(self, engine, context, depsgraph):
+        import gpu
+        from gpu_extras.presets import draw_texture_2d
+
+        # Navigating the viewport doesn't trigger view_update, the update
+        # only rewrites the camera
+        if self.get_view_key(self.get_view(context)) != self.view_key:
+            engine.tag_update()
+
+        if self.pixels is None:
+            return
+
+        if self.texture_version != self.version:
+            height, width = self.pixels.shape[:2]
+            data = gpu.types.Buffer('FLOAT', width * height * 4, self.pixels.ravel())
+            self.texture = gpu.types.GPUTexture((width, height), format='RGBA16F', data=data)
+            self.texture_version = self.version
+
+        gpu.state.blend_set('ALPHA_PREMULT')
+        draw_texture_2d(self.texture, (0, 0), context.region.width, context.region.height)
+        gpu.state.blend_set('NONE')
+
+    # Cancel the current pbrt run
+    def stop(self):
+        if self.process is not None and self.process.process.poll() is None:
+            self.process.terminate()
+        self.process = None
+
+        if self.display is not None:
+            self.display.close()
+            self.display = None
@@ -16,3 +16,12 @@
 # THE SOFTWARE.
 
 from .export import PBRTExporter
+from . import material
+
+
+def register():
+    material.register()
+
+
+def unregister():
+    material.unregister()
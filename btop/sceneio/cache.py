@@ -0,0 +1,462 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bpy
+
+import hashlib
+import os
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+# OpenImageIO is only needed to convert image textures, without it the
+# original files are used
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+
+# Bump this whenever the layout of the written shape files changes so
+# stale cache entries are not picked up anymore
+GEOMETRY_CACHE_VERSION = 2
+
+# Same for the converted texture files
+TEXTURE_CACHE_VERSION = 2
+
+# Extensions of packed images without a filepath
+IMAGE_FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'OPEN_EXR': '.exr',
+    'OPEN_EXR_MULTILAYER': '.exr',
+    'TARGA': '.tga',
+    'TARGA_RAW': '.tga',
+    'TIFF': '.tif',
+    'HDR': '.hdr',
+}
+
+# Formats both pbrt versions read, these are only converted when their
+# resolution needs to be capped
+PBRT_IMAGE_FORMATS = ('.png', '.tga', '.pfm', '.exr')
+
+
+class GeometryCache(object):
+    """
+    Stores the binary ply shape files of the exported meshes.
+    When enabled files are named by a content hash of the evaluated mesh,
+    so unchanged meshes reuse the file written by a previous export.
+    """
+
+    def __init__(self, folder, scene_folder, enabled=True, known_shapes=None, changed_objects=None):
+        self.folder = folder
+        self.scene_folder = scene_folder
+        self.enabled = enabled
+        # Object key -> ply file of its shape, kept across exports by the
+        # caller. Together with the names of the objects changed since the
+        # last export it lets unchanged objects skip reading their mesh.
+        self.known_shapes = known_shapes if known_shapes is not None else {}
+        self.changed_objects = changed_objects
+        self.hits = 0
+        self.misses = 0
+        # Keys written by this export, their files might still be in flight
+        self.written = set()
+        # Files referenced by the scene
+        self.references = set()
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    # Key of a scene object in known_shapes. Names can't be used, the
+    # objects of depsgraph instances all carry the name of their instancer.
+    # Those are evaluated objects which only live during one export, so
+    # they are left out and their meshes are always read.
+    def get_object_key(self, meshobj):
+        if meshobj.is_evaluated:
+            return None
+        return (meshobj.as_pointer(), meshobj.data.as_pointer())
+
+    # The ply file of an object that didn't change since the last export,
+    # None if the mesh needs to be read
+    def get_known_shape(self, meshobj):
+        if not self.enabled or self.changed_objects is None or meshobj.name in self.changed_objects:
+            return None
+
+        object_key = self.get_object_key(meshobj)
+        if object_key is None:
+            return None
+
+        filepath = self.known_shapes.get(object_key)
+        if filepath is None or not os.path.exists(filepath):
+            return None
+
+        self.hits += 1
+        return filepath
+
+    # Returns the ply filepath for the mesh and whether it still has to be written
+    def get_ply_path(self, meshobj, key):
+        if not self.enabled:
+            # Object names aren't unique among depsgraph instances, the
+            # count keeps shapes written at the same time apart
+            self.misses += 1
+            filename = '{}_{}.ply'.format(bpy.path.clean_name(meshobj.name), self.misses)
+            return os.path.join(self.folder, filename), True
+
+        filepath = os.path.join(self.folder, key + '.ply')
+        object_key = self.get_object_key(meshobj)
+        if object_key is not None:
+            self.known_shapes[object_key] = filepath
+        if key in self.written or os.path.exists(filepath):
+            self.hits += 1
+            return filepath, False
+
+        self.misses += 1
+        self.written.add(key)
+        return filepath, True
+
+    # Shapes are referenced relative to the scene file
+    def get_reference(self, filepath):
+        self.references.add(filepath)
+        return os.path.relpath(filepath, self.scene_folder).replace('\\', '/')
+
+    def report(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        return 'Geometry cache: {} hits, {} misses ({:.1%} hit ratio)'.format(self.hits, self.misses, ratio)
+
+
+def hash_arrays(arrays):
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update('v{}'.format(GEOMETRY_CACHE_VERSION).encode('ascii'))
+    for array in arrays:
+        if array is None:
+            hasher.update(b'none')
+            continue
+        hasher.update('{}{}'.format(array.dtype.str, array.shape).encode('ascii'))
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+# Add files referenced by a scene to its hash by their path, size and
+# modification time. Cached shapes are named by their content and converted
+# textures keep the modification time of their source, so both hash the
+# same across exports as long as they don't change.
+def update_file_hash(hasher, filepaths):
+    for filepath in sorted(filepaths):
+        try:
+            stat = os.stat(filepath)
+            hasher.update('{}:{}:{}\n'.format(filepath, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+        except OSError:
+            hasher.update('{}:missing\n'.format(filepath).encode('utf-8'))
+
+
+# Whether an image stores 8 or 16 bit integers, pbrt applies the
+# encoding or gamma of the image map only to those
+def is_integer_image(spec):
+    return spec.format.basetype in (oiio.UINT8, oiio.UINT16)
+
+
+# Convert an image into a file pbrt reads with the given resolution.
+# Integer images become png files of the same bit depth, so the encoding
+# or gamma of the image map still applies and pbrt keeps them at 8 or 16
+# bits in memory. Float images become half exr files.
+def convert_texture(source, target, resolution):
+    buf = oiio.ImageBuf(source)
+    spec = buf.spec()
+    if buf.has_error:
+        raise Exception('Failed to read texture {} : {}'.format(source, buf.geterror()))
+
+    if resolution != (spec.width, spec.height):
+        roi = oiio.ROI(0, resolution[0], 0, resolution[1], 0, 1, 0, spec.nchannels)
+        buf = oiio.ImageBufAlgo.resize(buf, roi=roi)
+
+    extension = os.path.splitext(target)[1]
+    if extension == '.png':
+        data_format = 'uint8' if spec.format.basetype == oiio.UINT8 else 'uint16'
+    else:
+        data_format = 'half'
+
+    temp_target = os.path.splitext(target)[0] + '.tmp' + extension
+    if not buf.write(temp_target, data_format):
+        raise Exception('Failed to write texture {} : {}'.format(temp_target, buf.geterror()))
+
+    # The modification time of the source marks the converted file as up to date
+    stat = os.stat(source)
+    os.utime(temp_target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_target, target)
+
+
+# Directions of the pixel centers of an equal-area square image, pbrt-v4's
+# EqualAreaSquareToSphere
+def equal_area_directions(resolution):
+    centers = (np.arange(resolution) + 0.5) / resolution
+    u = 2 * centers[np.newaxis, :] - 1
+    v = 2 * centers[:, np.newaxis] - 1
+    up = np.abs(u)
+    vp = np.abs(v)
+    signed_distance = 1 - (up + vp)
+    r = 1 - np.abs(signed_distance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phi = np.where(r == 0, 1, (vp - up) / r + 1) * np.pi / 4
+    z = np.copysign(1 - r * r, signed_distance)
+    cos_phi = np.copysign(np.cos(phi), u)
+    sin_phi = np.copysign(np.sin(phi), v)
+    scale = r * np.sqrt(np.maximum(0, 2 - r * r))
+    return cos_phi * scale, sin_phi * scale, z
+
+
+# Resample a lat-long image, rows top down, into the equal-area square
+# layout pbrt-v4 expects for environment and goniometric maps. This is
+# what pbrt-v4's --upgrade does with the maps of pbrt-v3 scenes.
+def equal_area_square(pixels, resolution):
+    height, width = pixels.shape[:2]
+    x, y, z = equal_area_directions(resolution)
+    theta = np.arccos(np.clip(z, -1, 1))
+    phi = np.arctan2(y, x) % (2 * np.pi)
+
+    # Bilinear lookup, wrapping around in phi and clamping in theta
+    s = phi / (2 * np.pi) * width - 0.5
+    t = theta / np.pi * height - 0.5
+    s0 = np.floor(s)
+    t0 = np.floor(t)
+    ds = (s - s0)[..., np.newaxis]
+    dt = (t - t0)[..., np.newaxis]
+    s0 = s0.astype(np.int64)
+    t0 = t0.astype(np.int64)
+    s1 = (s0 + 1) % width
+    s0 = s0 % width
+    t1 = np.clip(t0 + 1, 0, height - 1)
+    t0 = np.clip(t0, 0, height - 1)
+
+    top = pixels[t0, s0] * (1 - ds) + pixels[t0, s1] * ds
+    bottom = pixels[t1, s0] * (1 - ds) + pixels[t1, s1] * ds
+    return (top * (1 - dt) + bottom * dt).astype(np.float32)
+
+
+# Linear values of sRGB encoded ones
+def srgb_to_linear(values):
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+# Convert a lat-long map into an equal-area square half exr file. Integer
+# images are taken as sRGB like pbrt-v3 did for these maps.
+def convert_equal_area(source, target, max_resolution):
+    if oiio is not None:
+        buf = oiio.ImageBuf(source)
+        pixels = buf.get_pixels(oiio.FLOAT)
+        if pixels is None or buf.has_error:
+            raise Exception('Failed to read texture {} : {}'.format(source, buf.geterror()))
+        spec = buf.spec()
+        pixels = pixels.reshape(spec.height, spec.width, spec.nchannels)
+        srgb = is_integer_image(spec)
+    else:
+        # Blender keeps the encoded values of integer images in their pixels
+        image = bpy.data.images.load(source, check_existing=False)
+        try:
+            width, height = image.size
+            pixels = np.empty(width * height * 4, dtype=np.float32)
+            image.pixels.foreach_get(pixels)
+            srgb = not image.is_float
+        finally:
+            bpy.data.images.remove(image)
+        pixels = np.flipud(pixels.reshape(height, width, 4))
+
+    # Alpha means nothing for a light map
+    pixels = pixels[:, :, :3] if pixels.shape[2] >= 3 else pixels[:, :, :1]
+    if srgb:
+        pixels = srgb_to_linear(pixels)
+
+    resolution = max(pixels.shape[:2])
+    if max_resolution > 0:
+        resolution = min(resolution, max_resolution)
+    square = equal_area_square(pixels, resolution)
+
+    temp_target = os.path.splitext(target)[0] + '.tmp.exr'
+    if oiio is not None:
+        out = oiio.ImageBuf(oiio.ImageSpec(resolution, resolution, square.shape[2], oiio.FLOAT))
+        out.set_pixels(oiio.ROI(), square)
+        if not out.write(temp_target, 'half'):
+            raise Exception('Failed to write texture {} : {}'.format(temp_target, out.geterror()))
+    else:
+        if square.shape[2] == 1:
+            square = np.repeat(square, 3, axis=2)
+        square = np.concatenate((square, np.ones(square.shape[:2] + (1,), dtype=np.float32)), axis=2)
+        image = bpy.data.images.new('btop_equal_area', resolution, resolution, alpha=True, float_buffer=True)
+        try:
+            image.pixels.foreach_set(np.flipud(square).ravel())
+            image.filepath_raw = temp_target
+            image.file_format = 'OPEN_EXR'
+            image.save()
+        finally:
+            bpy.data.images.remove(image)
+
+    stat = os.stat(source)
+    os.utime(temp_target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_target, target)
+
+
+class TextureCache(object):
+    """
+    Stores image textures converted into png or half exr files, so pbrt
+    can read images in formats it doesn't support and capped textures
+    don't have to be resized on every render. Conversions run on a thread
+    pool while the rest of the scene is exported.
+    Converted files are named by a hash of the source path and the
+    resolution cap, and are redone when the source modification time changes.
+    Packed images are extracted into the cache as well.
+    """
+
+    def __init__(self, folder, scene_folder, max_resolution=0, workers=1, convert=True):
+        self.folder = folder
+        self.scene_folder = scene_folder
+        # Only extract packed images when False
+        self.convert = convert
+        # Largest width or height of a converted texture, 0 for no cap
+        self.max_resolution = max_resolution
+        self.executor = ThreadPoolExecutor(workers)
+        # Converted filepath -> conversion job of this export
+        self.jobs = {}
+        # Source filepath -> file referenced instead during this export
+        self.sources = {}
+        self.hits = 0
+        self.misses = 0
+        self.extracted = 0
+        # Files referenced by the scene
+        self.references = set()
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_resolution(self, width, height):
+        size = max(width, height)
+        if self.max_resolution <= 0 or size <= self.max_resolution:
+            return width, height
+
+        factor = self.max_resolution / size
+        return max(1, round(width * factor)), max(1, round(height * factor))
+
+    # Returns the file pbrt should load for the image, scheduling its
+    # conversion if needed
+    def get_path(self, filename):
+        source = os.path.abspath(bpy.path.abspath(filename))
+        if not self.convert or oiio is None or not os.path.isfile(source):
+            return source
+
+        if source in self.sources:
+            return self.sources[source]
+
+        image_input = oiio.ImageInput.open(source)
+        if image_input is None:
+            # Not an image OpenImageIO can read, leave it to pbrt
+            return source
+        spec = image_input.spec()
+        image_input.close()
+
+        resolution = self.get_resolution(spec.width, spec.height)
+        if os.path.splitext(source)[1].lower() in PBRT_IMAGE_FORMATS and resolution == (spec.width, spec.height):
+            self.sources[source] = source
+            return source
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update('v{}:{}:{}'.format(TEXTURE_CACHE_VERSION, source, self.max_resolution).encode('utf-8'))
+        extension = '.png' if is_integer_image(spec) else '.exr'
+        target = os.path.join(self.folder, hasher.hexdigest() + extension)
+        self.sources[source] = target
+
+        source_mtime = os.stat(source).st_mtime_ns
+        if os.path.exists(target) and os.stat(target).st_mtime_ns == source_mtime:
+            self.hits += 1
+            self.jobs[target] = None
+            return target
+
+        self.misses += 1
+        self.jobs[target] = self.executor.submit(convert_texture, source, target, resolution)
+        return target
+
+    # Returns the equal-area square version of a lat-long map, scheduling
+    # its conversion if needed. Without OpenImageIO the map is converted
+    # right away through Blender, which can't be used from other threads.
+    def get_equal_area_path(self, filename):
+        source = os.path.abspath(bpy.path.abspath(filename))
+        if not os.path.isfile(source):
+            return source
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update('v{}:equal-area:{}:{}'.format(TEXTURE_CACHE_VERSION, source, self.max_resolution).encode('utf-8'))
+        target = os.path.join(self.folder, hasher.hexdigest() + '.exr')
+        if target in self.jobs:
+            return target
+
+        source_mtime = os.stat(source).st_mtime_ns
+        if os.path.exists(target) and os.stat(target).st_mtime_ns == source_mtime:
+            self.hits += 1
+            self.jobs[target] = None
+            return target
+
+        self.misses += 1
+        if oiio is None:
+            convert_equal_area(source, target, self.max_resolution)
+            self.jobs[target] = None
+        else:
+            self.jobs[target] = self.executor.submit(convert_equal_area, source, target, self.max_resolution)
+        return target
+
+    # Filepath of an image datablock. Packed images are written into the
+    # cache named by the hash of their data, so the file is only written
+    # the first time that data shows up.
+    def get_image_filepath(self, image):
+        if image.packed_file is None:
+            return bpy.path.abspath(image.filepath, library=image.library)
+
+        data = image.packed_file.data
+        extension = os.path.splitext(image.filepath)[1].lower()
+        if not extension:
+            extension = IMAGE_FORMAT_EXTENSIONS.get(image.file_format, '.' + image.file_format.lower())
+
+        filepath = os.path.join(self.folder, hashlib.sha1(data).hexdigest() + extension)
+        if not os.path.exists(filepath):
+            temp_filepath = filepath + '.tmp'
+            with open(temp_filepath, 'wb') as image_file:
+                image_file.write(data)
+            os.replace(temp_filepath, filepath)
+            self.extracted += 1
+
+        return filepath
+
+    # Converted images are referenced relative to the scene file, images
+    # used as they are by their absolute path. Lat-long maps of lights are
+    # converted into pbrt-v4's equal-area layout with equal_area.
+    def get_reference(self, filename, equal_area=False):
+        if not filename:
+            return ''
+
+        path = self.get_equal_area_path(filename) if equal_area else self.get_path(filename)
+        self.references.add(path)
+        if os.path.dirname(path) == self.folder:
+            path = os.path.relpath(path, self.scene_folder)
+        return path.replace('\\', '/')
+
+    # Wait for the conversions, raises the first failed one
+    def wait(self):
+        try:
+            for job in self.jobs.values():
+                if job is not None:
+                    job.result()
+        finally:
+            self.executor.shutdown()
+
+    def report(self):
+        return 'Texture cache: {} converted, {} reused, {} packed images extracted'.format(
+            self.misses, self.hits, self.extracted)
@@ -20,6 +20,9 @@ import mathutils
 
 import math
 
+from ..misc import fmt
+from ..misc import fmt_values
+
 
 class CameraIO(object):
     """
@@ -31,6 +34,10 @@ class CameraIO(object):
         self.shutter_open = None
         self.shutter_close = None
         self.extra_params = {}
+        # (matrix_world, angle, (x, y) resolution, ortho scale) of a view to
+        # render instead of the scene camera, e.g. the 3d viewport. The ortho
+        # scale is None for perspective views.
+        self.view = None
 
     def write_to_file(self, writer):
         active_camera = bpy.context.scene.camera
@@ -39,51 +46,117 @@ class CameraIO(object):
         scale_line = 'Scale -1 1 1'
 
         # Get camera position and orientation
-        camera_matrix = active_camera.matrix_world
+        if self.view is not None:
+            camera_matrix = self.view[0]
+        else:
+            camera_matrix = active_camera.matrix_world
         eye_pos = camera_matrix.translation
         look_vec = mathutils.Vector((0, 0, -1))
         look_vec.rotate(camera_matrix.to_3x3())
         look_at = eye_pos + look_vec * 3
         up_vec = mathutils.Vector((0, 1, 0))
         up_vec.rotate(camera_matrix.to_3x3())
-        orient_line = 'LookAt {} {} {} {} {} {} {} {} {}'.format(*eye_pos.to_tuple(),
-                                                                   *look_at.to_tuple(),
-                                                                   *up_vec.to_tuple())
+        orient_line = 'LookAt {} {} {}'.format(fmt_values(eye_pos, 'position'),
+                                               fmt_values(look_at, 'position'),
+                                               fmt_values(up_vec, 'normal'))
+
+        if self.view is not None:
+            writer.write(scale_line + '\n')
+            writer.write(orient_line + '\n')
+            writer.write(self.get_view_line() + '\n\n')
+            return
 
         # Get camera properties
         camera_props = active_camera.data.pbrt_camera_props
+        if writer.version >= 4:
+            camera_line_comps = self.get_v4_comps(camera_props)
+        else:
+            camera_line_comps = self.get_v3_comps(camera_props)
+
+        # Write out
+        writer.write(scale_line + '\n')
+        writer.write(orient_line + '\n')
+        writer.write(' '.join(camera_line_comps) + '\n\n')
+
+    def get_v3_comps(self, camera_props):
         camera_line_comps = ['Camera "{}" "float shutteropen" {} "float shutterclose" {}'.format(camera_props.camera_type,
-                                                                                       camera_props.shutter_open,
-                                                                                       camera_props.shutter_close)]
+                                                                                       fmt(camera_props.shutter_open),
+                                                                                       fmt(camera_props.shutter_close))]
 
         if camera_props.camera_type != "realistic":
-            camera_line_comps.append('"float frameratio" {}'.format(camera_props.frame_ratio))
+            camera_line_comps.append('"float frameratio" {}'.format(fmt(camera_props.frame_ratio)))
             #camera_line_comps.append('"float screenwindow" [{} {} {} {}]'.format(camera_props.screen_window_x_min,
             #                                                                     camera_props.screen_window_x_max,
             #                                                                     camera_props.screen_window_y_min,
             #                                                                     camera_props.screen_window_y_max))
 
             if camera_props.camera_type != "environment":
-                camera_line_comps.append('"float lensradius" {}'.format(camera_props.lens_radius))
-                camera_line_comps.append('"float focaldistance" {}'.format(camera_props.focal_distance))
+                camera_line_comps.append('"float lensradius" {}'.format(fmt(camera_props.lens_radius)))
+                camera_line_comps.append('"float focaldistance" {}'.format(fmt(camera_props.focal_distance)))
 
             if camera_props.camera_type == "perspective":
                 # Get fov from camera attributes
-                angle = bpy.context.scene.camera.data.angle
-                ratio = bpy.context.scene.render.resolution_y / bpy.context.scene.render.resolution_x
-                fov = 2 * math.degrees(math.atan(ratio * math.tan(angle / 2)))
-                camera_line_comps.append('"float fov" {}'.format(fov))
+                camera_line_comps.append('"float fov" {}'.format(fmt(self.get_fov())))
 
         else:
             camera_line_comps.append('"string lensfile" "{}"'.format(camera_props.lens_file))
-            camera_line_comps.append('"float aperturediameter" {}'.format(camera_props.aperture_diameter))
-            camera_line_comps.append('"float focusdistance" {}'.format(camera_props.focus_distance))
+            camera_line_comps.append('"float aperturediameter" {}'.format(fmt(camera_props.aperture_diameter)))
+            camera_line_comps.append('"float focusdistance" {}'.format(fmt(camera_props.focus_distance)))
             camera_line_comps.append('"bool simpleweighting" "{}"'.format(camera_props.simple_weighting))
 
-        # Write out
-        writer.write(scale_line + '\n')
-        writer.write(orient_line + '\n')
-        writer.write(' '.join(camera_line_comps) + '\n\n')
+        return camera_line_comps
+
+    # pbrt-v4 names the aspect ratio frameaspectratio and renders environment
+    # maps with a spherical camera
+    def get_v4_comps(self, camera_props):
+        camera_type = camera_props.camera_type
+        if camera_type == "environment":
+            camera_type = "spherical"
+        camera_line_comps = ['Camera "{}" "float shutteropen" {} "float shutterclose" {}'.format(camera_type,
+                                                                                       fmt(camera_props.shutter_open),
+                                                                                       fmt(camera_props.shutter_close))]
+
+        if camera_type == "spherical":
+            camera_line_comps.append('"string mapping" "equirectangular"')
+
+        elif camera_type != "realistic":
+            camera_line_comps.append('"float frameaspectratio" {}'.format(fmt(camera_props.frame_ratio)))
+            camera_line_comps.append('"float lensradius" {}'.format(fmt(camera_props.lens_radius)))
+            camera_line_comps.append('"float focaldistance" {}'.format(fmt(camera_props.focal_distance)))
+
+            if camera_type == "perspective":
+                camera_line_comps.append('"float fov" {}'.format(fmt(self.get_fov())))
+
+        else:
+            camera_line_comps.append('"string lensfile" "{}"'.format(camera_props.lens_file))
+            camera_line_comps.append('"float aperturediameter" {}'.format(fmt(camera_props.aperture_diameter)))
+            camera_line_comps.append('"float focusdistance" {}'.format(fmt(camera_props.focus_distance)))
+
+        return camera_line_comps
+
+    # pbrt's fov from blender's camera angle, which spans the image width
+    def get_fov(self):
+        angle = bpy.context.scene.camera.data.angle
+        ratio = bpy.context.scene.render.resolution_y / bpy.context.scene.render.resolution_x
+        return 2 * math.degrees(math.atan(ratio * math.tan(angle / 2)))
+
+    # Perspective camera of the view, angle is the field of view of the
+    # larger side like blender's camera angle
+    def get_view_line(self):
+        matrix, angle, resolution, ortho_scale = self.view
+        ratio = min(resolution) / max(resolution)
+        if ortho_scale is not None:
+            # The ortho scale spans the longer side of the image
+            half_x = half_y = ortho_scale / 2
+            if resolution[0] >= resolution[1]:
+                half_y *= ratio
+            else:
+                half_x *= ratio
+            return 'Camera "orthographic" "float screenwindow" [{}]'.format(
+                fmt_values((-half_x, half_x, -half_y, half_y)))
+
+        fov = 2 * math.degrees(math.atan(ratio * math.tan(angle / 2)))
+        return 'Camera "perspective" "float fov" {}'.format(fmt(fov))
 
     def read_from_file(self, parser):
         pass
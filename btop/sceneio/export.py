@@ -16,12 +16,18 @@
 # THE SOFTWARE.
 
 import bpy, copy
+import os
 
 from .camera import CameraIO
 from .film import FilmIO
 from .sampler import SamplerIO
 from .integrator import IntegratorIO
 from .scene import SceneIO
+from .cache import GeometryCache
+from .cache import TextureCache
+from .cache import update_file_hash
+from .writer import StreamWriter
+from ..misc import set_precision
 
 
 class PBRTExporter(object):
@@ -29,22 +35,129 @@ class PBRTExporter(object):
     Export blender scene into a pbrt scene file
     """
 
-    def __init__(self):
+    def __init__(self, mesh_format='inline', use_geometry_cache=True, workers=0, precision=(9, 6, 6),
+                 use_texture_cache=True, texture_max_resolution=0, version=3):
+        # 'inline' writes trianglemesh shapes into the scene file,
+        # 'ply' writes binary ply files next to it
+        self.mesh_format = mesh_format
+        self.use_geometry_cache = use_geometry_cache
+        # Number of threads serializing shapes, 0 to use all cores
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        # Significant digits of positions, normals/uvs and other values
+        self.precision = precision
+        # Convert image textures pbrt can't read, optionally capping their resolution
+        self.use_texture_cache = use_texture_cache
+        self.texture_max_resolution = texture_max_resolution
+        # pbrt scene syntax version to write, 3 or 4
+        self.version = version
+        # Object name -> ply file of the last export, and the names of the
+        # objects changed since then. Set by interactive sessions so that
+        # unchanged meshes aren't read again, None to read all of them.
+        self.known_shapes = {}
+        self.changed_objects = None
+        # Hash the written scene and the files it references into scene_hash,
+        # e.g. to look up renders of the same scene
+        self.hash_scene = False
+        self.scene_hash = None
         self.cameraio = CameraIO()
         self.samplerio = SamplerIO()
         self.integratorio = IntegratorIO()
         self.filmio = FilmIO()
         self.sceneio = SceneIO()
 
-    def export(self, output_path):
-        file_handler = open(output_path, 'w')
+    # Exporter set up from the addon preferences
+    @classmethod
+    def from_preferences(cls, pref):
+        return cls(pref.pbrt_mesh_format, pref.pbrt_geometry_cache,
+                   pref.pbrt_export_workers,
+                   (pref.pbrt_position_digits, pref.pbrt_normal_digits, pref.pbrt_value_digits),
+                   pref.pbrt_texture_cache, pref.pbrt_texture_max_resolution,
+                   4 if pref.pbrt_use_v4 else 3)
 
-        self.cameraio.write_to_file(file_handler)
+    # Camera, sampler, integrator and film, everything before the world block
+    def write_options(self, writer):
+        self.cameraio.write_to_file(writer)
 
-        self.samplerio.write_to_file(file_handler)
-        self.integratorio.write_to_file(file_handler)
-        self.filmio.write_to_file(file_handler)
+        self.samplerio.write_to_file(writer)
+        self.integratorio.write_to_file(writer)
+        self.filmio.write_to_file(writer)
 
-        self.sceneio.write_to_file(file_handler)
+    # Write only the options into output_path and include the world block
+    # written by a previous export with world_path, e.g. when just the view
+    # of an interactive session changed
+    def export_options(self, output_path, world_path):
+        set_precision(*self.precision)
+        writer = StreamWriter.open(output_path, version=self.version)
+        try:
+            self.write_options(writer)
+            writer.write('Include "{}"\n'.format(
+                os.path.relpath(world_path, os.path.dirname(output_path)).replace('\\', '/')))
+        finally:
+            writer.close()
 
-        file_handler.close()
\ No newline at end of file
+    # With a stream the scene is written into it instead of output_path, e.g.
+    # the stdin of a running pbrt process. The files the scene references are
+    # still put next to output_path. With world_path the world block goes
+    # into a file of its own, which output_path includes.
+    def export(self, output_path, stream=None, world_path=None):
+        set_precision(*self.precision)
+        scene_folder = os.path.dirname(output_path)
+
+        geometry_cache = None
+        if self.mesh_format == 'ply':
+            # Cached shapes are shared by every scene file in the folder, uncached
+            # ones are kept next to the scene file they belong to
+            if self.use_geometry_cache:
+                geometry_cache = GeometryCache(os.path.join(scene_folder, 'geometry'), scene_folder,
+                                               known_shapes=self.known_shapes,
+                                               changed_objects=self.changed_objects)
+            else:
+                geometry_cache = GeometryCache(os.path.splitext(output_path)[0] + '_meshes', scene_folder, False)
+        self.sceneio.meshio.geometry_cache = geometry_cache
+        self.sceneio.lightio.geometry_cache = geometry_cache
+
+        # Packed images are extracted into the texture cache even when
+        # textures aren't converted
+        texture_cache = TextureCache(os.path.join(scene_folder, 'textures'), scene_folder,
+                                     self.texture_max_resolution, self.workers, self.use_texture_cache)
+        self.sceneio.materialio.texture_cache = texture_cache
+        self.sceneio.lightio.texture_cache = texture_cache
+        self.sceneio.materialio.version = self.version
+
+        if world_path is not None:
+            # The scene hash only covers the world block then
+            writer = StreamWriter.open(world_path, workers=self.workers, version=self.version,
+                                       hash_content=self.hash_scene)
+        elif stream is None:
+            writer = StreamWriter.open(output_path, workers=self.workers, version=self.version,
+                                       hash_content=self.hash_scene)
+        else:
+            writer = StreamWriter(stream, workers=self.workers, version=self.version,
+                                  hash_content=self.hash_scene)
+        self.scene_hash = None
+
+        try:
+            if world_path is None:
+                self.write_options(writer)
+            self.sceneio.write_to_file(writer)
+        finally:
+            # Waits for the shapes still being serialized and the textures
+            # still being converted
+            try:
+                writer.close()
+            finally:
+                texture_cache.wait()
+
+        if writer.hasher is not None:
+            references = texture_cache.references
+            if geometry_cache is not None:
+                references = references | geometry_cache.references
+            update_file_hash(writer.hasher, references)
+            self.scene_hash = writer.hasher.hexdigest()
+
+        if world_path is not None:
+            self.export_options(output_path, world_path)
+
+        if geometry_cache is not None and geometry_cache.enabled:
+            print(geometry_cache.report())
+        print(texture_cache.report())
\ No newline at end of file
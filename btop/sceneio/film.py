@@ -18,6 +18,9 @@
 import bpy
 import mathutils
 
+from ..misc import fmt
+from ..misc import fmt_values
+
 
 class FilmIO(object):
     """
@@ -25,7 +28,8 @@ class FilmIO(object):
     """
 
     def __init__(self):
-        pass
+        # Overrides the (x, y) resolution of the scene, e.g. for viewport renders
+        self.resolution = None
 
     def write_to_file(self, writer):
 
@@ -33,24 +37,30 @@ class FilmIO(object):
         render = bpy.context.scene.render
 
         # Currently image is the only film type
-        # Hard coded here
-        film_line_comps = ['Film "image"']
+        # Hard coded here, pbrt-v4 calls it rgb
+        film_line_comps = ['Film "rgb"' if writer.version >= 4 else 'Film "image"']
 
-        film_line_comps.append('"integer xresolution" {}'.format(render.resolution_x))
-        film_line_comps.append('"integer yresolution" {}'.format(render.resolution_y))
+        x_resolution, y_resolution = self.resolution or (render.resolution_x, render.resolution_y)
+        film_line_comps.append('"integer xresolution" {}'.format(x_resolution))
+        film_line_comps.append('"integer yresolution" {}'.format(y_resolution))
 
         crop_win_x_min = film_props.crop_window_x_min
         crop_win_x_max = film_props.crop_window_x_max
         crop_win_y_min = film_props.crop_window_y_min
         crop_win_y_max = film_props.crop_window_y_max
-        film_line_comps.append('"float cropwindow" [{} {} {} {}]'.format(crop_win_x_min,
-                                                                         crop_win_x_max,
-                                                                         crop_win_y_min,
-                                                                         crop_win_y_max))
-
-        film_line_comps.append('"float scale" {}'.format(film_props.scale))
-        film_line_comps.append('"float maxsampleluminance" {}'.format(film_props.max_sample_luminance))
-        film_line_comps.append('"float diagonal" {}'.format(film_props.diagonal))
+        film_line_comps.append('"float cropwindow" [{}]'.format(fmt_values((crop_win_x_min,
+                                                                            crop_win_x_max,
+                                                                            crop_win_y_min,
+                                                                            crop_win_y_max))))
+
+        if writer.version >= 4:
+            # pbrt-v4 scales the image by the sensor's iso, 100 being a scale of 1
+            film_line_comps.append('"float iso" {}'.format(fmt(film_props.scale * 100)))
+            film_line_comps.append('"float maxcomponentvalue" {}'.format(fmt(film_props.max_sample_luminance)))
+        else:
+            film_line_comps.append('"float scale" {}'.format(fmt(film_props.scale)))
+            film_line_comps.append('"float maxsampleluminance" {}'.format(fmt(film_props.max_sample_luminance)))
+        film_line_comps.append('"float diagonal" {}'.format(fmt(film_props.diagonal)))
         #film_line_comps.append('"string filename" "{}"'.format(film_props.filename))
 
         writer.write(' '.join(film_line_comps) + '\n\n')
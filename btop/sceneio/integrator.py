@@ -27,6 +27,10 @@ class IntegratorIO(object):
         pass
 
     def write_to_file(self, writer):
+        if writer.version >= 4:
+            self.write_v4(writer)
+            return
+
         integrator_props = bpy.context.scene.pbrt_integrator_props
         integrator_type = integrator_props.integrator_type
         integrator_line_comps = ['Integrator "{}"'.format(integrator_type)]
@@ -78,5 +82,39 @@ class IntegratorIO(object):
 
         writer.write(' '.join(integrator_line_comps) + '\n\n')
 
+    # pbrt-v4 has neither the direct lighting nor the whitted integrator. The
+    # pixel bounds are left out, pbrt-v4 only takes them on the film where
+    # they can't be combined with the crop window.
+    def write_v4(self, writer):
+        integrator_props = bpy.context.scene.pbrt_integrator_props
+        integrator_type = integrator_props.integrator_type
+        max_depth = integrator_props.max_depth
+        if integrator_type == "directlighting":
+            integrator_type, max_depth = "path", 1
+        elif integrator_type == "whited":
+            integrator_type = "path"
+
+        integrator_line_comps = ['Integrator "{}"'.format(integrator_type)]
+        integrator_line_comps.append('"integer maxdepth" {}'.format(max_depth))
+
+        if integrator_type == "path":
+            light_sampler = integrator_props.light_sample_strategy
+            integrator_line_comps.append('"string lightsampler" "{}"'.format(
+                'bvh' if light_sampler == 'spatial' else light_sampler))
+
+        if integrator_type == "mlt":
+            integrator_line_comps.append('"integer bootstrapsamples" {}'.format(integrator_props.bootstrap_samples))
+            integrator_line_comps.append('"integer chains" {}'.format(integrator_props.chains))
+            integrator_line_comps.append('"integer mutationsperpixel" {}'.format(integrator_props.mutations_per_pixel))
+            integrator_line_comps.append('"float largestepprobability" {}'.format(integrator_props.largest_step_probability))
+            integrator_line_comps.append('"float sigma" {}'.format(integrator_props.sigma))
+
+        if integrator_type == "sppm":
+            integrator_line_comps.append('"integer iterations" {}'.format(integrator_props.iterations))
+            integrator_line_comps.append('"integer photonsperiteration" {}'.format(integrator_props.photons_per_iteration))
+            integrator_line_comps.append('"float radius" {}'.format(integrator_props.radius))
+
+        writer.write(' '.join(integrator_line_comps) + '\n\n')
+
     def read_from_file(self, parser):
         pass
\ No newline at end of file
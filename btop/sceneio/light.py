@@ -20,7 +20,20 @@ import mathutils
 
 import math
 
-from .mesh import get_mesh_comps
+from .mesh import write_mesh
+from ..misc import fmt
+from ..misc import fmt_values
+
+
+# Path of an image map to write into the scene, converted by the texture
+# cache when there is one. pbrt-v4 only takes environment and goniometric
+# maps in its equal-area square layout, those need the texture cache.
+def get_image_reference(filename, texture_cache=None, equal_area=False):
+    if texture_cache is None:
+        if equal_area and filename:
+            raise Exception('Map {} needs a texture cache to be converted for pbrt-v4'.format(filename))
+        return filename.replace("\\", "/")
+    return texture_cache.get_reference(filename, equal_area)
 
 
 class LightIO(object):
@@ -30,11 +43,20 @@ class LightIO(object):
 
     def __init__(self):
         self.area_light_geometries = []
+        # Geometry cache to write binary ply shapes of area light geometries into
+        self.geometry_cache = None
+        # Texture cache to convert the light maps with
+        self.texture_cache = None
 
     def write_to_file(self, writer):
         # Clear area light geometry cache before each light export
         self.area_light_geometries = []
 
+        # pbrt-v4 renamed the image parameter and the point type
+        use_v4 = writer.version >= 4
+        map_param = 'filename' if use_v4 else 'mapname'
+        point_type = 'point3' if use_v4 else 'point'
+
         for object in bpy.data.objects:
             # Skip object write if hidden
             if object.hide_get():
@@ -50,38 +72,40 @@ class LightIO(object):
                 else:
                     raise Exception('light type {} not supported'.format(light_type))
 
-                light_color = object.data.color
+                light_color = fmt_values(object.data.color)
                 light_location = object.location
-                light_location_tuple = light_location.to_tuple()
+                light_location_str = fmt_values(light_location, 'position')
                 light_props = object.data.pbrt_light_props
                 area_light_pre_comps = []
-                area_light_post_comps = []
 
                 if light_type == 'POINT':
                     if light_props.isgoniometric:
-                        light_line_comps.append('"goniometric" "rgb I" [{} {} {}] "string mapname" "{}"'.format(
-                            light_color.r, light_color.g, light_color.b, light_props.mapname.replace("\\", "/")
+                        light_line_comps.append('"goniometric" "rgb I" [{}] "string {}" "{}"'.format(
+                            light_color, map_param,
+                            get_image_reference(light_props.mapname, self.texture_cache, use_v4)
                         ))
                     else:
                         light_line_comps.append('"point"')
-                        light_line_comps.append('"rgb I" [{} {} {}] "point from" [{} {} {}]'.format(
-                            light_color.r, light_color.g, light_color.b, *light_location_tuple
+                        light_line_comps.append('"rgb I" [{}] "{} from" [{}]'.format(
+                            light_color, point_type, light_location_str
                         ))
 
                 elif light_type == 'SUN':
                     if light_props.isprojection:
-                        light_line_comps.append('"projection" "rgb I" [{} {} {}] "string mapname" "{}"').format(
-                            light_color.r, light_color.g, light_color.b, light_props.mapname.replace("\\", "/")
-                        )
+                        light_line_comps.append('"projection" "string {}" "{}"'.format(
+                            map_param, get_image_reference(light_props.mapname, self.texture_cache)
+                        ))
+                        # The intensity of pbrt-v4's projection light only comes from the image
+                        if not use_v4:
+                            light_line_comps.append('"rgb I" [{}]'.format(light_color))
                     else:
                         light_line_comps.append('"distant"')
                         light_rotation = object.matrix_world.to_quaternion()
                         temp_vec = mathutils.Vector((0, 0, -1))
                         temp_vec.rotate(light_rotation)
                         light_direction = light_location + temp_vec
-                        light_direction_tuple = light_direction.to_tuple()
-                        light_line_comps.append('"rgb L" [{} {} {}] "point from" [{} {} {}] "point to" [{} {} {}]'.format(
-                            light_color.r, light_color.g, light_color.b, *light_location_tuple, *light_direction_tuple
+                        light_line_comps.append('"rgb L" [{}] "{type} from" [{}] "{type} to" [{}]'.format(
+                            light_color, light_location_str, fmt_values(light_direction, 'position'), type=point_type
                         ))
 
                 elif light_type == 'SPOT':
@@ -90,22 +114,22 @@ class LightIO(object):
                     temp_vec = mathutils.Vector((0, 0, -1))
                     temp_vec.rotate(light_rotation)
                     light_direction = light_location + temp_vec
-                    light_direction_tuple = light_direction.to_tuple()
                     spot_size = object.data.spot_size / math.pi * 180
                     spot_blend = object.data.spot_blend * spot_size
-                    light_line_comps.append('"rgb I" [{} {} {}] "point from" [{} {} {}] "point to" [{} {} {}] "float coneangle" {} "float conedeltaangle" {}'.format(
-                        light_color.r, light_color.g, light_color.b, *light_location_tuple, *light_direction_tuple,
-                        spot_size, spot_blend
+                    light_line_comps.append('"rgb I" [{}] "{type} from" [{}] "{type} to" [{}] "float coneangle" {} "float conedeltaangle" {}'.format(
+                        light_color, light_location_str, fmt_values(light_direction, 'position'),
+                        fmt(spot_size), fmt(spot_blend), type=point_type
                     ))
 
                 elif light_type == "AREA":
                     meshobj = light_props.geometry
                     if meshobj:
                         area_light_pre_comps.append('AttributeBegin')
-                        light_line_comps.append('"rgb L" [{} {} {}]'.format(light_color.r, light_color.g, light_color.b))
-                        light_line_comps.append('"bool twosided" "{}" "integer samples" {}'.format('true' if light_props.twosided else 'false', light_props.samples))
-                        area_light_post_comps += get_mesh_comps(meshobj, 1)
-                        area_light_post_comps.append('AttributeEnd')
+                        light_line_comps.append('"rgb L" [{}]'.format(light_color))
+                        light_line_comps.append('"bool twosided" "{}"'.format('true' if light_props.twosided else 'false'))
+                        # pbrt-v4 picks the number of light samples itself
+                        if not use_v4:
+                            light_line_comps.append('"integer samples" {}'.format(light_props.samples))
                         self.area_light_geometries.append(meshobj)
                     else:
                         # Area light illegal
@@ -113,15 +137,27 @@ class LightIO(object):
 
                 if light_type == "AREA":
                     area_light_pre_comps.append(' '.join(light_line_comps))
-                    writer.write('\n'.join(area_light_pre_comps + area_light_post_comps) + '\n\n')
+                    writer.write('\n'.join(area_light_pre_comps) + '\n')
+                    write_mesh(writer, meshobj, 1, self.geometry_cache)
+                    writer.write('AttributeEnd\n\n')
                 else:
-                    light_line_comps.append('"spectrum scale" [{} {}]'.format(light_props.scale, light_props.scale))
+                    if use_v4:
+                        light_line_comps.append('"float scale" {}'.format(fmt(light_props.scale)))
+                    else:
+                        light_line_comps.append('"spectrum scale" [{} {}]'.format(fmt(light_props.scale), fmt(light_props.scale)))
                     writer.write(' '.join(light_line_comps) + '\n\n')
 
         world_props = bpy.context.scene.pbrt_world_props
         light_line_comps = ['LightSource "infinite"']
         lum = world_props.luminance
-        light_line_comps.append('"rgb L" [{} {} {}] "integer samples" {} "string mapname" "{}"'.format(
-            lum.r, lum.g, lum.b, world_props.samples, world_props.mapname.replace("\\", "/")
-        ))
+        if not use_v4:
+            light_line_comps.append('"rgb L" [{}] "integer samples" {} "string mapname" "{}"'.format(
+                fmt_values(lum), world_props.samples, get_image_reference(world_props.mapname, self.texture_cache)
+            ))
+        # pbrt-v4 takes either a constant radiance or an environment map
+        elif world_props.mapname:
+            light_line_comps.append('"string filename" "{}"'.format(
+                get_image_reference(world_props.mapname, self.texture_cache, True)))
+        else:
+            light_line_comps.append('"rgb L" [{}]'.format(fmt_values(lum)))
         writer.write(' '.join(light_line_comps) + '\n\n')
@@ -17,7 +17,131 @@
 
 import bpy
 
+import hashlib
+import io
+
+from bpy.app.handlers import persistent
+
 from ..nodes import shading
+from ..misc.formatter import templates
+
+
+# Serialized text of the materials compiled by previous exports,
+# (material name, syntax version, precision, texture cache) -> (hash of the node tree,
+# text, referenced images, number of folded texture nodes, warnings)
+compiled_materials = {}
+
+# Entries taken out of compiled_materials because their material changed,
+# reused if the hash of the node tree shows the output didn't change
+stale_materials = {}
+
+
+def find_node(nodes, name):
+    for n in nodes:
+        if n.bl_idname == name:
+            return n
+    return None
+
+
+# Get the pbrt shader node connected to the material output
+def get_shader(material):
+    output_node = find_node(material.node_tree.nodes, 'ShaderNodeOutputMaterial')
+
+    if output_node is None:
+        raise Exception('Cannot find output node for material : %s' %material.name)
+
+    # Get PBRT shader node from output surface socket
+    shader = output_node.inputs['Surface'].links[0].from_node
+    if not hasattr(shader, 'export_named'):
+        # No shader fits
+        # TODO Attribute a standard material instead such that something is rendered?
+        print( '[btop.material.py] None pbrt material assigned : %s' %shader.name )
+
+        raise Exception('None pbrt material assigned : %s' %shader.name)
+
+    return shader
+
+
+# Hash of everything in the node tree that ends up in the exported text,
+# node locations, selection and the like are left out
+def hash_material(material):
+    hasher = hashlib.blake2b(digest_size=16)
+    builtin_props = {prop.identifier for prop in bpy.types.ShaderNode.bl_rna.properties}
+
+    def update(*values):
+        hasher.update(repr(values).encode('utf-8'))
+
+    for node in material.node_tree.nodes:
+        update(node.bl_idname, node.name)
+        for prop in node.bl_rna.properties:
+            if prop.identifier in builtin_props:
+                continue
+            value = getattr(node, prop.identifier)
+            if isinstance(value, bpy.types.Image):
+                # The repr of an image is only its name
+                value = hash_image(value)
+            elif hasattr(value, '__len__') and not isinstance(value, str):
+                value = tuple(value)
+            update(prop.identifier, value)
+
+        for sock in node.inputs:
+            value = getattr(sock, 'default_value', None)
+            if hasattr(value, '__len__') and not isinstance(value, str):
+                value = tuple(value)
+            update(sock.identifier, value)
+
+    for link in material.node_tree.links:
+        update(link.from_node.name, link.from_socket.identifier,
+               link.to_node.name, link.to_socket.identifier)
+
+    return hasher.hexdigest()
+
+
+# Packed images are extracted by the hash of their data, others are
+# referenced by their path
+def hash_image(image):
+    if image.packed_file is not None:
+        return image.name, hashlib.sha1(image.packed_file.data).hexdigest()
+    return image.name, image.filepath_raw
+
+
+# Move every compiled variant of the material to the stale entries
+def invalidate_material(name):
+    for key in [key for key in compiled_materials if key[0] == name]:
+        stale_materials[key] = compiled_materials.pop(key)
+
+
+#
+# Materials only get recompiled when the depsgraph reports a change on
+# them, re-rendering after a change to the camera, lights or objects
+# reuses the text of the previous export without touching the node trees.
+#
+@persistent
+def invalidate_compiled_materials(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Material):
+            # Every syntax version and setting the material was compiled
+            # with is out of date
+            invalidate_material(update.id.name)
+        elif isinstance(update.id, bpy.types.Image):
+            # Changing the filepath, reloading or repacking an image
+            # doesn't update the materials using it
+            image = update.id.original
+            for material in bpy.data.materials:
+                if material.node_tree is not None and any(
+                        getattr(node, 'image', None) == image for node in material.node_tree.nodes):
+                    invalidate_material(material.name)
+        elif isinstance(update.id, bpy.types.NodeTree) and not update.id.is_embedded_data:
+            # Node groups could be used by any material, the node trees
+            # embedded in materials come with an update of their material
+            compiled_materials.clear()
+            stale_materials.clear()
+
+
+@persistent
+def clear_compiled_materials(*args):
+    compiled_materials.clear()
+    stale_materials.clear()
 
 
 class MaterialIO(object):
@@ -26,35 +150,92 @@ class MaterialIO(object):
     """
 
     def __init__(self):
-        pass
+        self.compiled = 0
+        self.reused = 0
+        self.eliminated = 0
+        # Lossy conversions of the last export, e.g. to pbrt-v4 materials
+        self.warnings = []
+        # Texture cache converting the images of image textures, None to use them as they are
+        self.texture_cache = None
+        # pbrt scene syntax version, 3 or 4
+        self.version = 3
 
-    def write_to_file(self, writer, meshobj, indent=0):
+    # Serialized MakeNamedMaterial definition of the material and its
+    # textures, taken from the cache when the material didn't change
+    def compile(self, material):
+        texture_cache = self.texture_cache
+        key = (material.name, self.version, tuple(sorted(templates.items())),
+               (texture_cache.folder, texture_cache.max_resolution, texture_cache.convert) if texture_cache else None)
+        entry = compiled_materials.get(key)
+        if entry is not None:
+            self.reused += 1
+            self.eliminated += entry[3]
+            self.warnings.extend(entry[4])
+            self.update_images(entry[2])
+            return entry[1]
+
+        # Changes like moving a node trigger an update too, the hash tells
+        # whether the output would actually change
+        entry = stale_materials.pop(key, None)
+        material_hash = hash_material(material)
+        if entry is not None and entry[0] == material_hash:
+            self.reused += 1
+            text, images, eliminated, warnings = entry[1:]
+            self.update_images(images)
+        else:
+            self.compiled += 1
+            buffer = io.StringIO()
+            textures = shading.TextureRegistry(material.name, texture_cache, self.version)
+            get_shader(material).export_named(material.name, 0, buffer, textures)
+            text, images, eliminated = buffer.getvalue(), textures.images, len(textures.eliminated)
+            warnings = textures.warnings
+
+        self.eliminated += eliminated
+        self.warnings.extend(warnings)
+        compiled_materials[key] = (material_hash, text, images, eliminated, warnings)
+        return text
+
+    # Reused material text references converted images by a path which
+    # doesn't change, the images might still need to be converted again
+    # and are still referenced by the scene
+    def update_images(self, images):
+        if self.texture_cache is not None:
+            for image in images:
+                self.texture_cache.get_reference(image)
 
-        def write_with_indent(idnt, content):
-            writer.write('\t' * idnt + content)
+    # Define every material once up front with MakeNamedMaterial, objects
+    # only reference them by name
+    def write_materials(self, writer, materials):
+        self.compiled = 0
+        self.reused = 0
+        self.eliminated = 0
+        self.warnings = []
 
-        def find_node(nodes, name):
-            for n in nodes:
-                if n.bl_idname == name:
-                    return n
-            return None
+        for material in materials:
+            writer.write(self.compile(material))
 
-        # Get output node from active material
+        writer.write('\n')
+        print('Material cache: {} compiled, {} reused'.format(self.compiled, self.reused))
+        print('Texture folding: {} texture evaluations eliminated'.format(self.eliminated))
+        for warning in self.warnings:
+            print('Warning: ' + warning)
+
+    def write_to_file(self, writer, meshobj, indent=0):
         material = meshobj.active_material
-        output_node = find_node(material.node_tree.nodes, 'ShaderNodeOutputMaterial')
+        if material is None:
+            return
 
-        if output_node is None:
-            raise Exception('Cannot find output node for material : %s' %material.name)
+        writer.write('\t' * indent + 'NamedMaterial "{}"\n'.format(material.name))
 
-        # Get PBRT shader node from output surface socket
-        shader = output_node.inputs['Surface'].links[0].from_node
-        # Export from the shader node
-        if hasattr(shader, 'export'):
-            shader.export(indent, writer)
 
-        else:
-            # No shader fits
-            # TODO Attribute a standard material instead such that something is rendered?
-            print( '[btop.material.py] None pbrt material assigned : %s' %shader.name )
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(invalidate_compiled_materials)
+    bpy.app.handlers.load_post.append(clear_compiled_materials)
+    bpy.app.handlers.undo_post.append(clear_compiled_materials)
+
 
-            raise Exception('None pbrt material assigned : %s' %shader.name)
\ No newline at end of file
+def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(invalidate_compiled_materials)
+    bpy.app.handlers.load_post.remove(clear_compiled_materials)
+    bpy.app.handlers.undo_post.remove(clear_compiled_materials)
+    clear_compiled_materials()
@@ -16,17 +16,76 @@
 # THE SOFTWARE.
 
 import bpy
-import bmesh
+import numpy as np
 
 import math
+import os
 
+from .cache import hash_arrays
 from ..misc import triangulate
 from ..misc import triangulateUV
-
-
-# This part of code will be used by area light mesh export, make it a function
-def get_mesh_comps(meshobj, indent=0):
-    mesh_comps = []
+from ..misc import read_mesh_buffers
+from ..misc import fmt
+from ..misc import fmt_values
+
+
+# Build the vertex and index arrays from the raw mesh buffers.
+# Returns points, normals, uvs and triangle indices, normals and uvs
+# are None when the mesh doesn't have an uv layer.
+def get_mesh_arrays(buffers):
+    if buffers.uvs is None:
+        points, indices = triangulate(buffers)
+        return points, None, None, indices
+
+    return triangulateUV(buffers)
+
+
+# Content hash of the evaluated mesh, computed from the raw mesh buffers so
+# a cache hit skips welding as well as serialization.
+def hash_mesh(buffers):
+    return hash_arrays(buffers)
+
+
+# Write the mesh into a little endian binary ply file.
+# Vertex attributes are interleaved into a single float32 block and faces
+# are written as a (count, i0, i1, i2) record array so both go straight
+# from the buffers to the file.
+def write_ply(filepath, buffers):
+    points, normals, uvs, indices = get_mesh_arrays(buffers)
+
+    vertex_props = ['x', 'y', 'z']
+    columns = [points]
+    if normals is not None:
+        vertex_props += ['nx', 'ny', 'nz']
+        columns.append(normals)
+    if uvs is not None:
+        vertex_props += ['u', 'v']
+        columns.append(uvs)
+    vertices = np.hstack(columns).astype('<f4', copy=False)
+
+    faces = np.empty(len(indices) // 3, dtype=[('count', 'u1'), ('indices', '<i4', (3,))])
+    faces['count'] = 3
+    faces['indices'] = indices.reshape(-1, 3)
+
+    header = ['ply', 'format binary_little_endian 1.0']
+    header.append('element vertex {}'.format(len(vertices)))
+    header += ['property float {}'.format(prop) for prop in vertex_props]
+    header.append('element face {}'.format(len(faces)))
+    header.append('property list uchar int vertex_indices')
+    header.append('end_header')
+
+    # Write to a temporary file first so an interrupted export never leaves
+    # a truncated file behind for the geometry cache to pick up
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'wb') as ply_file:
+        ply_file.write(('\n'.join(header) + '\n').encode('ascii'))
+        ply_file.write(np.ascontiguousarray(vertices).tobytes())
+        ply_file.write(faces.tobytes())
+    os.replace(temp_filepath, filepath)
+
+
+def get_transform_comps(meshobj, indent=0):
+    transform_comps = []
 
     # Get translation and scale
     matrix = meshobj.matrix_world
@@ -54,69 +113,86 @@ def get_mesh_comps(meshobj, indent=0):
     rotate_vec = (x_fac, y_fac, z_fac)
 
     # Write out transformation
-    mesh_comps.append(indent * '\t' + 'Translate {} {} {}'.format(*translation))
-    mesh_comps.append(indent * '\t' + 'Scale {} {} {}'.format(*scale))
-    mesh_comps.append(indent * '\t' + 'Rotate {} {} {} {}'.format(rotate_angle, *rotate_vec))
-
-
-    # 2021-05-20 James Tompkin
-    #
-    # Here, passing in meshobj and accessing vertices by meshobj.vertices does not provide the 
-    # animated position of verts.
-    # Instead, generate new transformed vertices to consider the animation of the object.
-    # From https://odederell3d.blog/2020/09/28/blender-python-access-animated-vertices-data/
-    #
-    depgraph = bpy.context.evaluated_depsgraph_get()
-    bm = bmesh.new()
-    bm.verts.ensure_lookup_table()
-    bm.from_object( meshobj, depgraph )
-
-    hasUVs = meshobj.data.uv_layers != None and len(meshobj.data.uv_layers) > 0
-    if hasUVs:
-        verts, normals, uvs, faces = triangulateUV(meshobj, bm)
-        mesh_comps.append(indent * '\t' + '# Num verts: {}  Num normals: {}  Num uvs: {}  Num faces: {}'.format( len(verts), len(normals), len(uvs), len(faces) ) )
-    else:
-        verts, faces = triangulate(meshobj, bm)
-        mesh_comps.append(indent * '\t' + '# Num verts: {}  Num faces: {}'.format( len(verts), len(faces) ) )
+    transform_comps.append(indent * '\t' + 'Translate ' + fmt_values(translation, 'position'))
+    transform_comps.append(indent * '\t' + 'Scale ' + fmt_values(scale, 'position'))
+    transform_comps.append(indent * '\t' + 'Rotate {} {}'.format(fmt(rotate_angle, 'position'),
+                                                                fmt_values(rotate_vec, 'position')))
 
+    return transform_comps
 
-    mesh_comps.append(indent * '\t' + 'Shape "trianglemesh"')
 
+def write_array_param(writer, indent, prefix, array, postfix, kind='value'):
+    writer.write(indent * '\t' + prefix)
+    writer.write_array(array, kind)
+    writer.write(postfix)
 
-    # James Tompkin: This is messy because I'm bad at Python; but it works.
-    # TODO triangulate and triangulateUV should use the same data structures.
-    if not hasUVs:
-        vert_str = ''
-        for vert in verts:
-            vert_str += '{} {} {} '.format(*vert.to_tuple())
-        mesh_comps.append((indent + 1) * '\t' + '"point P" [' + vert_str[:-1] + ' ]')
 
-        face_str = ''
-        for face in faces:
-            face_str += '{} {} {} '.format(*face)
-        mesh_comps.append((indent + 1) * '\t' + '"integer indices" [ ' + face_str[:-1] + ' ]')
+# If geometry_cache is given the shape is written as a binary ply file stored
+# in it and referenced by a plymesh shape, otherwise it's streamed inline.
+def write_shape(writer, meshobj, indent=0, geometry_cache=None):
+    # 2021-05-20 James Tompkin
+    #
+    # Accessing vertices by meshobj.data.vertices does not provide the
+    # animated position of verts, use the evaluated object instead so
+    # that animation and modifiers are considered.
+    # Objects coming from depsgraph instances are evaluated already
+    if geometry_cache is not None:
+        ply_path = geometry_cache.get_known_shape(meshobj)
+        if ply_path is not None:
+            writer.write(indent * '\t' + 'Shape "plymesh" "string filename" "{}"\n'.format(
+                geometry_cache.get_reference(ply_path)))
+            return
+
+    if meshobj.is_evaluated:
+        eval_obj = meshobj
     else:
-        vert_str = ''
-        for vert in verts:
-            vert_str += '{} {} {} '.format(*vert)
-        mesh_comps.append((indent + 1) * '\t' + '"point P" [' + vert_str[:-1] + ' ]')
-
-        normal_str = ''
-        for n in normals:
-            normal_str += '{} {} {} '.format(*n)
-        mesh_comps.append((indent + 1) * '\t' + '"normal N" [' + normal_str[:-1] + ' ]')
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        eval_obj = meshobj.evaluated_get(depsgraph)
+    mesh = eval_obj.to_mesh()
+
+    try:
+        buffers = read_mesh_buffers(mesh)
+    finally:
+        eval_obj.to_mesh_clear()
+
+    # Writing the ply file is handed to the writer's worker threads
+    if geometry_cache is not None:
+        key = hash_mesh(buffers) if geometry_cache.enabled else None
+        ply_path, needs_write = geometry_cache.get_ply_path(meshobj, key)
+        if needs_write:
+            writer.submit(write_ply, ply_path, buffers)
+        writer.write(indent * '\t' + 'Shape "plymesh" "string filename" "{}"\n'.format(
+            geometry_cache.get_reference(ply_path)))
+        return
+
+    # Formatting the arrays holds the GIL, worker threads wouldn't speed
+    # it up, so inline shapes are streamed right away
+    write_trianglemesh(writer, buffers, indent)
+
+
+def write_trianglemesh(writer, buffers, indent=0):
+    points, normals, uvs, indices = get_mesh_arrays(buffers)
+
+    if uvs is not None:
+        writer.write(indent * '\t' + '# Num verts: {}  Num normals: {}  Num uvs: {}  Num faces: {}\n'.format(
+            len(points), len(normals), len(uvs), len(indices) // 3))
+    else:
+        writer.write(indent * '\t' + '# Num verts: {}  Num faces: {}\n'.format(len(points), len(indices) // 3))
 
-        uv_str = ''
-        for uv in uvs:
-            uv_str += '{} {} '.format(*uv)
-        mesh_comps.append((indent + 1) * '\t' + '"float uv" [' + uv_str[:-1] + ' ]')
+    writer.write(indent * '\t' + 'Shape "trianglemesh"\n')
+    # pbrt-v4 has distinct types for 3d and 2d points
+    point_type, uv_type = ('point3', 'point2') if writer.version >= 4 else ('point', 'float')
+    write_array_param(writer, indent + 1, '"{} P" ['.format(point_type), points, ' ]\n', 'position')
+    if uvs is not None:
+        write_array_param(writer, indent + 1, '"normal N" [', normals, ' ]\n', 'normal')
+        write_array_param(writer, indent + 1, '"{} uv" ['.format(uv_type), uvs, ' ]\n', 'uv')
+    write_array_param(writer, indent + 1, '"integer indices" [ ', indices, ' ]\n')
 
-        face_str = ''
-        for face in faces:
-            face_str += '{} '.format(face)
-        mesh_comps.append((indent + 1) * '\t' + '"integer indices" [ ' + face_str[:-1] + ' ]')
 
-    return mesh_comps
+# This part of code will be used by area light mesh export, make it a function
+def write_mesh(writer, meshobj, indent=0, geometry_cache=None):
+    writer.write('\n'.join(get_transform_comps(meshobj, indent)) + '\n')
+    write_shape(writer, meshobj, indent, geometry_cache)
 
 
 class MeshIO(object):
@@ -125,12 +201,18 @@ class MeshIO(object):
     """
 
     def __init__(self):
-        pass
+        # Geometry cache to write binary ply shapes into, None to write shapes inline
+        self.geometry_cache = None
 
     def write_to_file(self, writer, meshobj, indent=0):
-        mesh_comps = get_mesh_comps(meshobj, indent)
-        writer.write('\n'.join(mesh_comps) + '\n\n')
+        write_mesh(writer, meshobj, indent, self.geometry_cache)
+        writer.write('\n')
+
+    # Write the shape only, used for object definitions that get their
+    # transformation from the instances
+    def write_shape_to_file(self, writer, meshobj, indent=0):
+        write_shape(writer, meshobj, indent, self.geometry_cache)
+        writer.write('\n')
 
     def read_from_file(self, parser):
         pass
-
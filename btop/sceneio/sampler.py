@@ -17,6 +17,15 @@
 
 import bpy
 
+import math
+
+
+# pbrt-v4 names of the v3 samplers
+v4_sampler_types = {
+    'o2sequence': 'paddedsobol',
+    'random': 'independent',
+}
+
 
 class SamplerIO(object):
     """
@@ -24,19 +33,27 @@ class SamplerIO(object):
     """
 
     def __init__(self):
-        pass
+        # Overrides the sample count of the scene, e.g. for viewport renders
+        self.pixel_samples = None
 
     def write_to_file(self, writer):
         # Get sampler properties
         sampler_props = bpy.context.scene.pbrt_sampler_props
-        sampler_line_comps = ['Sampler "{}"'.format(sampler_props.sampler_type)]
+        sampler_type = sampler_props.sampler_type
+        if writer.version >= 4:
+            sampler_type = v4_sampler_types.get(sampler_type, sampler_type)
+        sampler_line_comps = ['Sampler "{}"'.format(sampler_type)]
 
         if sampler_props.sampler_type != "stratified":
-            sampler_line_comps.append('"integer pixelsamples" {}'.format(sampler_props.pixel_samples))
+            pixel_samples = self.pixel_samples or sampler_props.pixel_samples
+            sampler_line_comps.append('"integer pixelsamples" {}'.format(pixel_samples))
         else:
+            xsamples, ysamples = sampler_props.xsamples, sampler_props.ysamples
+            if self.pixel_samples:
+                xsamples = ysamples = math.ceil(math.sqrt(self.pixel_samples))
             sampler_line_comps.append('"bool jitter" "{}"'.format(sampler_props.jitter))
-            sampler_line_comps.append('"integer xsamples" {}'.format(sampler_props.xsamples))
-            sampler_line_comps.append('"integer ysamples" {}'.format(sampler_props.ysamples))
+            sampler_line_comps.append('"integer xsamples" {}'.format(xsamples))
+            sampler_line_comps.append('"integer ysamples" {}'.format(ysamples))
 
         # Write out
         writer.write(' '.join(sampler_line_comps) + '\n\n')
@@ -16,10 +16,29 @@
 # THE SOFTWARE.
 
 import bpy
+import numpy as np
 
 from .mesh import MeshIO
 from .material import MaterialIO
 from .light import LightIO
+from ..misc.formatter import templates
+
+
+def get_matrix_array(matrix):
+    # pbrt takes the matrix in column major order
+    return np.array(matrix, dtype=np.float64).T.ravel()
+
+
+# Objects with the same key share their geometry and material and can be
+# written once as an object definition
+def get_instance_key(object):
+    # Modifiers give every object its own evaluated mesh
+    if len(object.modifiers) > 0:
+        return None
+
+    # Linked libraries can hold different meshes with the same name
+    material = object.active_material
+    return (object.data.as_pointer(), material.name if material else '')
 
 
 class SceneIO(object):
@@ -31,6 +50,66 @@ class SceneIO(object):
         self.meshio = MeshIO()
         self.materialio = MaterialIO()
         self.lightio = LightIO()
+        # Written for the viewport, picks the visibility flags to follow
+        self.viewport = False
+
+    # Instancers and particle emitters can hide their own geometry
+    def show_instancer(self, object):
+        if not object.is_instancer and len(object.particle_systems) == 0:
+            return True
+        return object.show_instancer_for_viewport if self.viewport else object.show_instancer_for_render
+
+    def write_object(self, writer, object):
+        writer.write('AttributeBegin\n')
+        self.materialio.write_to_file(writer, object)
+        self.meshio.write_to_file(writer, object)
+        writer.write('AttributeEnd\n\n')
+
+    def write_shared_mesh(self, writer, name, object):
+        writer.write('ObjectBegin "{}"\n'.format(name))
+        self.materialio.write_to_file(writer, object)
+        self.meshio.write_shape_to_file(writer, object)
+        writer.write('ObjectEnd\n\n')
+
+    # Write a whole batch of instances of one object definition, matrices is
+    # a (n, 16) array of column major matrices
+    def write_instances(self, writer, name, matrices):
+        template = 'AttributeBegin\n\tConcatTransform [' + ' '.join([templates['position']] * 16) + \
+                   ']\n\tObjectInstance "' + name.replace('%', '%%') + '"\nAttributeEnd\n\n'
+        rows_per_chunk = max(1, writer.chunk_size // 16)
+        for start in range(0, len(matrices), rows_per_chunk):
+            chunk = matrices[start:start + rows_per_chunk]
+            writer.write(''.join(template % tuple(row) for row in chunk.tolist()))
+
+    # Instances generated by collection instances, particle systems, geometry
+    # nodes and vertex/face instancing. Every source geometry is written once
+    # as an object definition and placed by all of its instances.
+    def write_depsgraph_instances(self, writer, depsgraph):
+        instance_names = {}
+        instance_matrices = {}
+
+        for instance in depsgraph.object_instances:
+            if not instance.is_instance:
+                continue
+
+            object = instance.object
+            if object.type != 'MESH' or object.original in self.lightio.area_light_geometries:
+                continue
+
+            material = object.active_material
+            key = (object.data.as_pointer(), material.name if material else '')
+            if key not in instance_names:
+                # The instance object is only valid during the iteration, so
+                # the definition gets written the first time it shows up
+                name = 'instance:{}:{}'.format(len(instance_names), object.data.name)
+                self.write_shared_mesh(writer, name, object)
+                instance_names[key] = name
+                instance_matrices[key] = []
+
+            instance_matrices[key].append(get_matrix_array(instance.matrix_world))
+
+        for key, name in instance_names.items():
+            self.write_instances(writer, name, np.array(instance_matrices[key]))
 
     def write_to_file(self, writer):
 
@@ -42,18 +121,54 @@ class SceneIO(object):
         # 2021-05-26 James Tompkin - 
         # Don't write output for all data objects; only output for all scene objects
         #for object in bpy.data.objects:
+        mesh_objects = []
         for object in bpy.context.scene.objects:
             # Skip object write if hidden in scene
-            if object.hide_get():
+            if object.hide_get() or not self.show_instancer(object):
                 continue
 
             if object.type == 'MESH' and object not in self.lightio.area_light_geometries:
-                writer.write('AttributeBegin\n')
-                self.materialio.write_to_file(writer, object)
-                self.meshio.write_to_file(writer, object)
-                writer.write('AttributeEnd\n\n')
+                mesh_objects.append(object)
+
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+        # Materials need to be defined before the objects referencing them
+        materials = {}
+        for object in mesh_objects:
+            if object.active_material is not None:
+                materials[object.active_material.name] = object.active_material
+        for instance in depsgraph.object_instances:
+            object = instance.object
+            if instance.is_instance and object.type == 'MESH' and object.active_material is not None:
+                materials.setdefault(object.active_material.name, object.active_material.original)
+        self.materialio.write_materials(writer, materials.values())
+
+        # Group the objects sharing mesh data, e.g. linked duplicates
+        shared_meshes = {}
+        for object in mesh_objects:
+            key = get_instance_key(object)
+            if key is not None:
+                shared_meshes.setdefault(key, []).append(object)
+
+        for object in mesh_objects:
+            key = get_instance_key(object)
+            if key is None or len(shared_meshes[key]) == 1:
+                self.write_object(writer, object)
+
+        # Write shared meshes once and place them with instances
+        for index, (key, objects) in enumerate(shared_meshes.items()):
+            if len(objects) == 1:
+                continue
+
+            name = 'mesh:{}:{}'.format(index, objects[0].data.name)
+            self.write_shared_mesh(writer, name, objects[0])
+            self.write_instances(writer, name, np.array([get_matrix_array(o.matrix_world) for o in objects]))
+
+        self.write_depsgraph_instances(writer, depsgraph)
 
-        writer.write('WorldEnd\n')
+        # The world block ends with the file in pbrt-v4
+        if writer.version < 4:
+            writer.write('WorldEnd\n')
 
     def read_from_file(self, parser):
         pass
\ No newline at end of file
@@ -0,0 +1,90 @@
+# This source file is part of btop
+#
+# This software is released under the GPL-3.0 license.
+#
+# Copyright (c) 2020 Joey Chen. All rights reserved.
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ..misc import fmt_array
+
+
+# Number of array values formatted at once
+CHUNK_SIZE = 65536
+
+# Size of the buffer in front of the scene file
+BUFFER_SIZE = 1 << 20
+
+
+class StreamWriter(object):
+    """
+    Buffered writer for the scene file.
+    Arrays are formatted in fixed size chunks and streamed into the file,
+    so memory usage is bounded by the chunk size instead of the mesh size.
+
+    With more than one worker, jobs which don't write into the scene file,
+    e.g. ply shape files, run on a thread pool and are finished when the
+    writer closes.
+
+    The writer also carries the pbrt syntax version the scene is written
+    in, the exporters pick their directives and parameter names from it.
+    Optionally the content is hashed as it's written out.
+    """
+
+    def __init__(self, file_handler, chunk_size=CHUNK_SIZE, workers=1, version=3, hash_content=False):
+        self.file_handler = file_handler
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.version = version
+        self.hasher = hashlib.blake2b(digest_size=16) if hash_content else None
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        # Background jobs which don't write into the scene file
+        self.jobs = []
+
+    @classmethod
+    def open(cls, filepath, chunk_size=CHUNK_SIZE, workers=1, version=3, hash_content=False):
+        return cls(open(filepath, 'w', buffering=BUFFER_SIZE), chunk_size, workers, version, hash_content)
+
+    def write(self, content):
+        if self.hasher is not None:
+            self.hasher.update(content.encode('utf-8'))
+        self.file_handler.write(content)
+
+    # Write the values of an array separated by spaces, kind picks the
+    # precision of float arrays
+    def write_array(self, array, kind='value'):
+        values = array.ravel()
+        for start in range(0, len(values), self.chunk_size):
+            if start > 0:
+                self.write(' ')
+            self.write(fmt_array(values[start:start + self.chunk_size], kind))
+
+    # Run a job that doesn't write into the scene file, e.g. writing an
+    # external shape file. It's finished at the latest when the writer closes.
+    def submit(self, func, *args):
+        if self.executor is None:
+            func(*args)
+        else:
+            self.jobs.append(self.executor.submit(func, *args))
+
+    def close(self):
+        try:
+            for job in self.jobs:
+                job.result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file_handler.close()
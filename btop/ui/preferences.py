@@ -41,12 +41,137 @@ class PBRTPreferences(bpy.types.AddonPreferences):
                                         description="Use version 4 pbrt binary",
                                         default=False)
 
+    pbrt_mesh_format: bpy.props.EnumProperty(name="pbrt_mesh_format",
+                                             description="How mesh shapes are written out",
+                                             items=[
+                                                 ("inline", "Inline", "Write trianglemesh shapes into the scene file"),
+                                                 ("ply", "Binary PLY", "Write binary ply files next to the scene file"),
+                                             ],
+                                             default="inline")
+
+    pbrt_geometry_cache: bpy.props.BoolProperty(name="pbrt_geometry_cache",
+                                                description="Reuse the ply files of meshes that didn't change since the last export",
+                                                default=True)
+
+    pbrt_export_workers: bpy.props.IntProperty(name="pbrt_export_workers",
+                                               description="Number of threads serializing shapes during export, 0 to use all cores",
+                                               default=0,
+                                               min=0)
+
+    pbrt_position_digits: bpy.props.IntProperty(name="pbrt_position_digits",
+                                                description="Significant digits of exported positions and transformations, 9 is full float precision",
+                                                default=9,
+                                                min=1,
+                                                max=17)
+
+    pbrt_normal_digits: bpy.props.IntProperty(name="pbrt_normal_digits",
+                                              description="Significant digits of exported normals and uvs",
+                                              default=6,
+                                              min=1,
+                                              max=17)
+
+    pbrt_value_digits: bpy.props.IntProperty(name="pbrt_value_digits",
+                                             description="Significant digits of exported colors and other parameters",
+                                             default=6,
+                                             min=1,
+                                             max=17)
+
+    pbrt_texture_cache: bpy.props.BoolProperty(name="pbrt_texture_cache",
+                                               description="Convert image textures pbrt can't read or whose resolution is capped into the cache folder, needs OpenImageIO",
+                                               default=True)
+
+    pbrt_texture_max_resolution: bpy.props.IntProperty(name="pbrt_texture_max_resolution",
+                                                       description="Largest width or height of converted textures, e.g. for preview renders, 0 to keep the full resolution",
+                                                       default=0,
+                                                       min=0)
+
+    pbrt_display_server: bpy.props.BoolProperty(name="pbrt_display_server",
+                                                description="Show the image while pbrt-v4 renders it through its display server",
+                                                default=True)
+
+    pbrt_viewport_scale: bpy.props.FloatProperty(name="pbrt_viewport_scale",
+                                                 description="Resolution of viewport renders relative to the viewport size",
+                                                 default=0.5,
+                                                 min=0.05,
+                                                 max=1,
+                                                 subtype='FACTOR')
+
+    pbrt_viewport_samples: bpy.props.IntProperty(name="pbrt_viewport_samples",
+                                                 description="Samples per pixel of viewport renders",
+                                                 default=4,
+                                                 min=1)
+
+    pbrt_animation_jobs: bpy.props.IntProperty(name="pbrt_animation_jobs",
+                                               description="Number of frames rendered at once by the animation render, the cores are split between them, 0 to pick from the core count",
+                                               default=0,
+                                               min=0)
+
+    pbrt_stream_scene: bpy.props.BoolProperty(name="pbrt_stream_scene",
+                                              description="Pipe the scene into pbrt while it's exported instead of writing a scene file, pbrt parses it as it comes in. Tiled renders still use a scene file",
+                                              default=False)
+
+    pbrt_result_cache: bpy.props.BoolProperty(name="pbrt_result_cache",
+                                              description="Load the image of an earlier render when the exported scene, the files it references and pbrt didn't change",
+                                              default=False)
+
+    pbrt_result_cache_size: bpy.props.IntProperty(name="pbrt_result_cache_size",
+                                                  description="Size of the cached renders in MB, the least recently used ones are removed beyond it, 0 for no limit",
+                                                  default=4096,
+                                                  min=0)
+
+    pbrt_tile_render: bpy.props.BoolProperty(name="pbrt_tile_render",
+                                             description="Split final renders into crop window tiles spread over the local and remote workers",
+                                             default=False)
+
+    pbrt_tile_count: bpy.props.IntProperty(name="pbrt_tile_count",
+                                           description="Number of tiles a frame is split into",
+                                           default=16,
+                                           min=1)
+
+    pbrt_local_workers: bpy.props.IntProperty(name="pbrt_local_workers",
+                                              description="Number of pbrt processes rendering tiles on this machine, the cores are split between them",
+                                              default=1,
+                                              min=0)
+
+    pbrt_remote_hosts: bpy.props.StringProperty(name="pbrt_remote_hosts",
+                                                description="Comma separated ssh hosts rendering tiles, each needs pbrt in its path and rsync",
+                                                default="")
+
+    pbrt_remote_folder: bpy.props.StringProperty(name="pbrt_remote_folder",
+                                                 description="Folder the cache folder is copied into on the remote hosts",
+                                                 default="/tmp/btop")
+
     def draw(self, context):
         layout = self.layout
 
         layout.row().prop(self, 'pbrt_location', text="PBRT location")
         layout.row().prop(self, 'pbrt_cache_folder', text="Cache Folder")
         layout.row().prop(self, 'pbrt_use_v4', text="Use Version 4")
+        if self.pbrt_use_v4:
+            layout.row().prop(self, 'pbrt_display_server', text="Live Display")
+        layout.row().prop(self, 'pbrt_mesh_format', text="Mesh Format")
+        if self.pbrt_mesh_format == 'ply':
+            layout.row().prop(self, 'pbrt_geometry_cache', text="Geometry Cache")
+        layout.row().prop(self, 'pbrt_export_workers', text="Export Threads")
+        layout.row().prop(self, 'pbrt_position_digits', text="Position Digits")
+        layout.row().prop(self, 'pbrt_normal_digits', text="Normal/UV Digits")
+        layout.row().prop(self, 'pbrt_value_digits', text="Value Digits")
+        layout.row().prop(self, 'pbrt_texture_cache', text="Texture Cache")
+        if self.pbrt_texture_cache:
+            layout.row().prop(self, 'pbrt_texture_max_resolution', text="Max Texture Resolution")
+        layout.row().prop(self, 'pbrt_viewport_scale', text="Viewport Resolution")
+        layout.row().prop(self, 'pbrt_viewport_samples', text="Viewport Samples")
+        layout.row().prop(self, 'pbrt_animation_jobs', text="Concurrent Frames")
+        layout.row().prop(self, 'pbrt_stream_scene', text="Stream Scene")
+        layout.row().prop(self, 'pbrt_result_cache', text="Result Cache")
+        if self.pbrt_result_cache:
+            layout.row().prop(self, 'pbrt_result_cache_size', text="Result Cache Size (MB)")
+        layout.row().prop(self, 'pbrt_tile_render', text="Tiled Render")
+        if self.pbrt_tile_render:
+            layout.row().prop(self, 'pbrt_tile_count', text="Tiles")
+            layout.row().prop(self, 'pbrt_local_workers', text="Local Workers")
+            layout.row().prop(self, 'pbrt_remote_hosts', text="Remote Hosts")
+            layout.row().prop(self, 'pbrt_remote_folder', text="Remote Folder")
 
 
 def get_pref():
@@ -50,6 +50,35 @@ class PBRTSamplerProperties(bpy.types.PropertyGroup):
                                     soft_max=128,
                                     min=1)
 
+    adaptive: bpy.props.BoolProperty(name="adaptive",
+                                     description="Render in passes with different seeds until the noise is low enough, needs pbrt-v4",
+                                     default=False)
+
+    pass_samples: bpy.props.IntProperty(name="pass_samples",
+                                        description="The number of samples per pixel of each pass",
+                                        default=16,
+                                        soft_max=128,
+                                        min=1)
+
+    target_error: bpy.props.FloatProperty(name="target_error",
+                                          description="Stop once the mean relative error of the pixels is below this",
+                                          default=1.0,
+                                          min=0.01,
+                                          max=100,
+                                          subtype='PERCENTAGE')
+
+    time_budget: bpy.props.FloatProperty(name="time_budget",
+                                         description="Don't start another pass that would end after this many seconds, 0 for no limit",
+                                         default=0,
+                                         min=0,
+                                         subtype='TIME_ABSOLUTE',
+                                         unit='TIME_ABSOLUTE')
+
+    max_passes: bpy.props.IntProperty(name="max_passes",
+                                      description="The largest number of passes to render",
+                                      default=64,
+                                      min=2)
+
 
 class PBRT_PT_sampler(bpy.types.Panel):
     bl_label = "Sampler"
@@ -76,6 +105,13 @@ class PBRT_PT_sampler(bpy.types.Panel):
             layout.row().prop(sampler_props, "xsamples", text="X Samples")
             layout.row().prop(sampler_props, "ysamples", text="Y Samples")
 
+        layout.row().prop(sampler_props, "adaptive", text="Adaptive")
+        if sampler_props.adaptive:
+            layout.row().prop(sampler_props, "pass_samples", text="Samples per Pass")
+            layout.row().prop(sampler_props, "target_error", text="Target Error")
+            layout.row().prop(sampler_props, "time_budget", text="Time Budget")
+            layout.row().prop(sampler_props, "max_passes", text="Max Passes")
+
 
 def register():
     # Register property group